@@ -0,0 +1,29 @@
+"""
+Пережатие фото перед отправкой в Gemini.
+
+Модуль без побочных эффектов (ни БД, ни бота, ни Gemini): его функции
+выполняются в процессах пула, которые не должны тянуть за собой taste.py.
+"""
+import io
+import time
+
+from PIL import Image
+
+
+def downscale_jpeg(image_bytes: bytes, target_px: int, quality: int) -> bytes:
+    """Уменьшить изображение до target_px по длинной стороне и пережать в JPEG."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        if max(img.size) <= target_px:
+            return image_bytes
+        img.draft("RGB", (target_px, target_px))  # JPEG декодируется сразу с уменьшением
+        img = img.convert("RGB")
+        img.thumbnail((target_px, target_px), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True)
+    data = out.getvalue()
+    return data if len(data) < len(image_bytes) else image_bytes
+
+
+def warm_up(seconds: float = 0.1) -> None:
+    """Занять воркер ненадолго — чтобы пул запустил все процессы сразу, а не по требованию."""
+    time.sleep(seconds)
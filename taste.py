@@ -4,20 +4,42 @@
 
 import os
 import re
+import string
+import textwrap
+import sys
 import json
+import time
+import random
+import heapq
+import hashlib
+import hmac
+import itertools
+import multiprocessing
+import queue
 import sqlite3
 import asyncio
 import logging
 import atexit
 import base64
 import aiohttp
+import io
 import ssl, certifi
-from datetime import date, datetime, timedelta
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
 import google.generativeai as genai
+try:
+    from PIL import Image
+    import imaging
+except ImportError:  # без Pillow поиск похожих фото и пережатие просто отключены
+    Image = None
 load_dotenv()
 
 # ==========
@@ -35,15 +57,33 @@ GEMINI_API_KEY = os.getenv("GOOGLE_GEMINI_API_KEY")
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
-dp.workflow_data = {}
 
-genai.configure(api_key=GEMINI_API_KEY)
+# свой адрес API (прокси или локальный тестовый сервер, например http://127.0.0.1:8089) — через REST
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")
+if GEMINI_API_ENDPOINT:
+    genai.configure(api_key=GEMINI_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
 logging.basicConfig(level=logging.INFO)
 
 # ========== Stripe & aiohttp для webhook ==========
 import stripe
 from aiohttp import web
 
+# Веб-сервер (Stripe, страницы оплаты, Telegram webhook) и режим webhook.
+# Webhook не делает бота горизонтально масштабируемым: база — локальный файл SQLite,
+# а кэш пользователей, диалоги, альбомы и страницы /history живут в памяти процесса.
+# Поддерживается один процесс бота на базу; второй (перекрытие при деплое) не должен
+# рассылать автоотчёты — см. SUMMARY_SCHEDULER.
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT") or os.getenv("PORT") or "8080")  # PORT задаёт платформа (Procfile web:)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")        # https://bot.example.com — пусто: long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# по умолчанию выводится из токена бота — не меняется между перезапусками и деплоями
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))   # одновременно обрабатываемых апдейтов
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "1000"))     # дальше — 503, Telegram повторит позже
+
 # Stripe config — подгружаются из .env
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")  # webhook signing secret
@@ -59,117 +99,985 @@ if STRIPE_SECRET_KEY:
 # 🗄️ База данных
 # ======================================
 
-conn = sqlite3.connect("tastebalance.db", check_same_thread=False)
-cursor = conn.cursor()
+DB_PATH = os.getenv("DB_PATH", "tastebalance.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))                    # пул соединений только для чтения
+DB_BATCH_MAX_OPS = int(os.getenv("DB_BATCH_MAX_OPS", "256"))      # максимум операций в одном коммите
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", "20"))  # сколько ждать попутчиков для коммита
+# full   — ждём COMMIT, synchronous=FULL (максимальная надёжность)
+# normal — ждём COMMIT, synchronous=NORMAL (по умолчанию)
+# lazy   — write-behind: не ждём COMMIT, при падении процесса теряются последние миллисекунды
+DB_DURABILITY = os.getenv("DB_DURABILITY", "normal")
 
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS meals(
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    description TEXT,
-    calories REAL,
-    protein REAL,
-    fat REAL,
-    carbs REAL,
-    date TEXT,
-    time TEXT
-)
-""")
+class Database:
+    """SQLite в режиме WAL: одна задача-писатель с групповыми коммитами + пул читателей.
 
+    Запись — `await db.execute(...)`: операция ставится в очередь, писатель
+    собирает до DB_BATCH_MAX_OPS операций (или ждёт DB_FLUSH_INTERVAL_MS)
+    в одну транзакцию и будит ожидающих после COMMIT. В режиме lazy
+    ожидания нет вовсе. Чтение — `await db.fetchone/fetchall(...)` в
+    отдельном потоке на своём соединении.
+    """
+
+    def __init__(self, path, readers=DB_READERS, durability=DB_DURABILITY,
+                 batch_max_ops=DB_BATCH_MAX_OPS, flush_interval_ms=DB_FLUSH_INTERVAL_MS):
+        self.path = path
+        self.durability = durability
+        self.batch_max_ops = batch_max_ops
+        self.flush_interval = flush_interval_ms / 1000
+        self.writer = self._connect()
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute(f"PRAGMA synchronous={'FULL' if durability == 'full' else 'NORMAL'}")
+
+        # статистика групповых коммитов
+        self.batches = 0
+        self.ops = 0
+        self.max_batch = 0
+        self.flush_time_total = 0.0
+        self.flush_time_max = 0.0
+
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect(read_only=True))
+        self._read_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+        self._queue = None  # asyncio.Queue — создаётся в работающем event loop
+        self._writer_task = None
+        self._collecting = []  # операции, уже вынутые из очереди, но ещё не отданные писателю
+
+    def _connect(self, read_only=False):
+        c = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        c.execute("PRAGMA busy_timeout=5000")
+        if read_only:
+            c.execute("PRAGMA query_only=1")  # читатели не пишут: запись в обход писателя — ошибка, а не гонка
+        return c
+
+    # ---------- чтение ----------
+
+    def _read(self, sql, params, many):
+        c = self._readers.get()
+        try:
+            cur = c.execute(sql, params)
+            return cur.fetchall() if many else cur.fetchone()
+        finally:
+            self._readers.put(c)
+
+    async def fetchone(self, sql, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, self._read, sql, params, False)
+
+    async def fetchall(self, sql, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, self._read, sql, params, True)
+
+    # ---------- запись ----------
+
+    async def execute(self, sql, params=(), wait=None):
+        """Выполнить запись; возвращает lastrowid после коммита (или None в режиме lazy)."""
+        rowids = await self.transaction([(sql, params)], wait=wait)
+        return rowids[-1] if rowids else None
+
+    async def transaction(self, ops, wait=None, on_commit=None):
+        """Атомарно выполнить несколько операций [(sql, params), ...].
+
+        wait=None — по настройке DB_DURABILITY; wait=True — всегда ждать COMMIT
+        (нужно, если вызывающему важен lastrowid).
+        on_commit() вызывается, когда пачка с операциями завершилась (в том числе в режиме lazy).
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        fut = asyncio.get_running_loop().create_future()
+        if on_commit is not None:
+            fut.add_done_callback(lambda _: on_commit())
+        self._queue.put_nowait((ops, fut))
+        if wait is None:
+            wait = self.durability != "lazy"
+        if wait:
+            return await fut
+        fut.add_done_callback(self._log_failure)
+        return None
+
+    @staticmethod
+    def _log_failure(fut):
+        if not fut.cancelled() and fut.exception():
+            logging.error(f"⚠️ Отложенная запись в БД не удалась: {fut.exception()}")
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self._collecting = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_max_ops:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait())
+            self._collecting = []
+            try:
+                results = await loop.run_in_executor(self._write_pool, self._apply, [ops for ops, _ in batch])
+            except Exception as e:
+                logging.exception("Ошибка группового коммита")
+                results = [e] * len(batch)
+            for (_, fut), res in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+
+    def _apply(self, batch):
+        """Выполнить пачку операций одной транзакцией; ошибка одной не откатывает остальные."""
+        started = time.perf_counter()
+        results = []
+        c = self.writer
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            for ops in batch:
+                c.execute("SAVEPOINT op")
+                try:
+                    rowids = [c.execute(sql, params).lastrowid for sql, params in ops]
+                    c.execute("RELEASE op")
+                    results.append(rowids)
+                except Exception as e:
+                    c.execute("ROLLBACK TO op")
+                    c.execute("RELEASE op")
+                    results.append(e)
+            c.execute("COMMIT")
+        except Exception:
+            if c.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.ops += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.flush_time_total += elapsed
+        self.flush_time_max = max(self.flush_time_max, elapsed)
+        return results
+
+    def stats(self):
+        return {
+            "durability": self.durability,
+            "batches": self.batches,
+            "ops": self.ops,
+            "avg_batch": round(self.ops / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "avg_flush_ms": round(self.flush_time_total / self.batches * 1000, 2) if self.batches else 0.0,
+            "max_flush_ms": round(self.flush_time_max * 1000, 2),
+            "pending": self._queue.qsize() if self._queue else 0,
+        }
+
+    def flush_pending(self):
+        """Синхронно дописать всё, что осталось в очереди (вызывается при остановке)."""
+        pending = [ops for ops, _ in self._collecting]
+        self._collecting = []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait()[0])
+        if pending:
+            self._apply(pending)
+            logging.info(f"💾 При остановке дописано {len(pending)} операций в БД")
+
+    def close(self):
+        self._read_pool.shutdown(wait=False)
+        self._write_pool.shutdown(wait=True)
+        try:
+            self.flush_pending()
+        except Exception:
+            logging.exception("Не удалось дописать очередь БД при остановке")
+        logging.info(f"🗄️ Статистика записи в БД: {self.stats()}")
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        self.writer.close()
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS cache(
-    hash TEXT PRIMARY KEY,
-    result TEXT
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users(
-    user_id INTEGER PRIMARY KEY,
-    is_premium INTEGER DEFAULT 0,
-    last_date TEXT,
-    photos_today INTEGER DEFAULT 0,
-    premium_until TEXT
-)
-""")
 
-conn.commit()
-atexit.register(conn.close)
+db = Database(DB_PATH)
 
 
 # ======================================
-# ⚙️ Вспомогательные функции
+# 🧱 Миграции схемы
 # ======================================
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция — функция,
+# получающая соединение писателя; выполняется один раз, в своей транзакции.
+# Новые изменения схемы — только новой функцией в конце MIGRATIONS.
+
+def _fill_daily_totals(c):
+    c.execute("DELETE FROM daily_totals")
+    c.execute("""
+        INSERT INTO daily_totals (user_id, date, kcal, p, f, c, meal_count)
+        SELECT user_id, date, SUM(calories), SUM(protein), SUM(fat), SUM(carbs), COUNT(*)
+        FROM meals GROUP BY user_id, date
+    """)
+
+
+def period_key(kind, day):
+    """Ключ периода для недельных и месячных сумм: '2025-W07' (ISO-неделя) или '2025-02'."""
+    if kind == "week":
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    return day.strftime("%Y-%m")
+
+
+def period_bounds(kind, day):
+    """Первый и последний день недели (пн–вс) или месяца, в который попадает day."""
+    if kind == "week":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    start = day.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+def _fill_period_totals(c):
+    """Недельные и месячные суммы из daily_totals (meals не читаем)."""
+    c.execute("DELETE FROM period_totals")
+    totals = {}
+    for user_id, day, kcal, p, f, carbs in c.execute("SELECT user_id, date, kcal, p, f, c FROM daily_totals"):
+        try:
+            d = date.fromisoformat(day)
+        except (TypeError, ValueError):
+            continue
+        for kind in ("week", "month"):
+            row = totals.setdefault((user_id, kind, period_key(kind, d)), [0, 0, 0, 0, 0])
+            row[0] += kcal or 0
+            row[1] += p or 0
+            row[2] += f or 0
+            row[3] += carbs or 0
+            row[4] += 1
+    c.executemany(
+        "INSERT INTO period_totals (user_id, kind, period, kcal, p, f, c, days) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (key + tuple(row) for key, row in totals.items()),
+    )
+
+
+def _migration_1_base_schema(c):
+    """Исходные таблицы (для старых баз без user_version всё уже может существовать)."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS meals(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        description TEXT,
+        calories REAL,
+        protein REAL,
+        fat REAL,
+        carbs REAL,
+        date TEXT,
+        time TEXT
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS cache(
+        hash TEXT PRIMARY KEY,
+        result TEXT
+    )
+    """)
+
+    # TTL и LRU для кэша — колонки добавляются к уже существующей таблице
+    for col in ("created_at REAL", "last_used REAL"):
+        try:
+            c.execute(f"ALTER TABLE cache ADD COLUMN {col}")
+        except sqlite3.OperationalError:
+            pass  # колонка уже есть
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        user_id INTEGER PRIMARY KEY,
+        is_premium INTEGER DEFAULT 0,
+        last_date TEXT,
+        photos_today INTEGER DEFAULT 0,
+        premium_until TEXT
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS photo_hashes(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        model TEXT,
+        phash INTEGER,
+        result TEXT,
+        created_at REAL
+    )
+    """)
+
+    daily_totals_exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_totals'"
+    ).fetchone()
+
+    # Дневные суммы по пользователю — обновляются в save_meal, /stats и отчёты читают одну строку
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_totals(
+        user_id INTEGER,
+        date TEXT,
+        kcal REAL DEFAULT 0,
+        p REAL DEFAULT 0,
+        f REAL DEFAULT 0,
+        c REAL DEFAULT 0,
+        meal_count INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, date)
+    )
+    """)
+    if not daily_totals_exists:
+        _fill_daily_totals(c)
+
+
+def _migration_2_indexes(c):
+    """Покрывающие индексы для /history, премиум-выборки и чистки кэша."""
+    # /history: WHERE user_id=? AND date>=? ORDER BY date, time — все колонки в индексе, в таблицу не ходим
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_meals_user_date_time
+    ON meals(user_id, date, time, description, calories, protein, fat, carbs)
+    """)
+    # частичный индекс: в нём только премиум-пользователи (единицы процентов таблицы)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_users_premium
+    ON users(user_id, premium_until) WHERE is_premium=1
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache(last_used)")
+    c.execute("ANALYZE")
+
+
+def _migration_3_workflow_state(c):
+    """Состояние диалогов (редактирование блюда, ручной ввод) — переживает перезапуск."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS workflow_state(
+        user_id INTEGER PRIMARY KEY,
+        data TEXT,
+        updated_at REAL
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_state_updated ON workflow_state(updated_at)")
+
+
+def _migration_4_summary_ledger(c):
+    """Какие автоотчёты уже отправлены — рассылка не дублируется после перезапуска."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS summary_ledger(
+        user_id INTEGER,
+        kind TEXT,
+        period TEXT,
+        status TEXT,
+        sent_at REAL,
+        PRIMARY KEY (user_id, kind, period)
+    ) WITHOUT ROWID
+    """)
+
+
+def _migration_5_user_timezone(c):
+    """Часовой пояс пользователя для автоотчётов (IANA-имя или смещение UTC+03:00)."""
+    c.execute("ALTER TABLE users ADD COLUMN tz TEXT")
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_users_premium_tz
+    ON users(user_id, tz) WHERE is_premium=1
+    """)
+
+
+def _migration_6_period_totals(c):
+    """Недельные и месячные суммы — отчёты читают одну строку на период, а не meals."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS period_totals(
+        user_id INTEGER,
+        kind TEXT,
+        period TEXT,
+        kcal REAL DEFAULT 0,
+        p REAL DEFAULT 0,
+        f REAL DEFAULT 0,
+        c REAL DEFAULT 0,
+        days INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, kind, period)
+    ) WITHOUT ROWID
+    """)
+    _fill_period_totals(c)
+
+
+def _migration_7_history_keyset(c):
+    """Постраничная /history по (date, time, id): id в индексе — без сортировки при равном времени."""
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_meals_history
+    ON meals(user_id, date, time, id, description, calories, protein, fat, carbs)
+    """)
+    c.execute("DROP INDEX IF EXISTS idx_meals_user_date_time")
+
+
+def _migration_8_photo_hashes_created(c):
+    """Чистка индекса похожих фото по TTL — по created_at без полного прохода по таблице."""
+    c.execute("CREATE INDEX IF NOT EXISTS idx_photo_hashes_created ON photo_hashes(created_at)")
+
+
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_indexes,
+    _migration_3_workflow_state,
+    _migration_4_summary_ledger,
+    _migration_5_user_timezone,
+    _migration_6_period_totals,
+    _migration_7_history_keyset,
+    _migration_8_photo_hashes_created,
+]
+
+
+def migrate():
+    """Применить недостающие миграции. Вызывается при старте, до запуска писателя."""
+    c = db.writer
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            migration(c)
+            c.execute(f"PRAGMA user_version={number}")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        logging.info(f"🧱 Миграция схемы {number}: {migration.__name__}")
+
+
+def rebuild_daily_totals():
+    """Пересобрать daily_totals из meals, а за ними недельные и месячные суммы. Только при старте."""
+    c = db.writer
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        _fill_daily_totals(c)
+        _fill_period_totals(c)
+        c.execute("COMMIT")
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+    return c.execute("SELECT COUNT(*) FROM daily_totals").fetchone()[0]
+
+
+# запросы горячих путей — для `python taste.py --explain`
+HOT_QUERIES = {
+    "history": (
+        "SELECT id, date, time, description, calories, protein, fat, carbs "
+        "FROM meals WHERE user_id=? AND date>=? AND (date, time, id) < (?, ?, ?) "
+        "ORDER BY date DESC, time DESC, id DESC LIMIT 11",
+        (1, "2000-01-01", "2100-01-01", "00:00", 0),
+    ),
+    "get_stats": ("SELECT kcal, p, f, c FROM daily_totals WHERE user_id=? AND date=?", (1, "2000-01-01")),
+    "premium_scan": ("SELECT user_id FROM users WHERE is_premium=1", ()),
+}
 
-def cache_get(key: str):
-    """Получить значение из кэша."""
-    cursor.execute("SELECT result FROM cache WHERE hash=?", (key,))
-    row = cursor.fetchone()
-    return row[0] if row else None
 
+def explain_hot_queries():
+    """Напечатать план и время каждого горячего запроса."""
+    c = db.writer
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = "; ".join(row[-1] for row in c.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        started = time.perf_counter()
+        rows = len(c.execute(sql, params).fetchall())
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"{name}: {elapsed:.2f} ms, {rows} rows\n    {plan}")
 
-def cache_set(key: str, value: str):
+
+migrate()
+atexit.register(db.close)
+
+
+# ======================================
+# 🧠 Кэш результатов Gemini
+# ======================================
+
+CACHE_TTL = int(os.getenv("CACHE_TTL_SECONDS", str(30 * 24 * 3600)))  # 30 дней
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "2000"))            # LRU в памяти
+CACHE_DB_MAX_ROWS = int(os.getenv("CACHE_DB_MAX_ROWS", "50000"))       # лимит таблицы cache
+
+
+def cache_scope(kind, model):
+    """
+    Область кэша: модель + версия шаблона промпта. Варианты промпта (A/B через PROMPT_VARIANT)
+    и новые версии шаблона не отдают друг другу закэшированные ответы.
+    """
+    return f"{model}|{get_prompt(kind, model).version}"
+
+
+def make_cache_key(scope: str, payload) -> str:
+    """Ключ кэша: область (cache_scope) + SHA-256 байтов фото или нормализованного текста."""
+    if isinstance(payload, str):
+        payload = " ".join(payload.lower().split()).encode("utf-8")
+    return f"{scope}:{hashlib.sha256(payload).hexdigest()}"
+
+
+class ResultCache:
+    """Двухуровневый кэш ответов Gemini: LRU в памяти + таблица cache в SQLite, с TTL."""
+
+    def __init__(self, max_items=CACHE_MAX_ITEMS, ttl=CACHE_TTL, db_max_rows=CACHE_DB_MAX_ROWS):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.db_max_rows = db_max_rows
+        self._mem = OrderedDict()  # key -> (created_at, result)
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str):
+        now = time.time()
+        entry = self._mem.get(key)
+        if entry is not None:
+            if now - entry[0] < self.ttl:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._mem[key]
+
+        row = await db.fetchone("SELECT result, created_at FROM cache WHERE hash=?", (key,))
+        if row and row[1] and now - row[1] < self.ttl:
+            # last_used нужен только для вытеснения — COMMIT не ждём
+            await db.execute("UPDATE cache SET last_used=? WHERE hash=?", (now, key), wait=False)
+            self._remember(key, row[1], row[0])
+            self.hits += 1
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        now = time.time()
+        self._remember(key, now, value)
+        await db.execute(
+            "INSERT OR REPLACE INTO cache (hash, result, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, value, now, now)
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            await self._prune_db()
+
+    def _remember(self, key, created_at, value):
+        self._mem[key] = (created_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    async def _prune_db(self):
+        """Удаляет просроченные записи и самые давно использованные сверх лимита."""
+        await db.transaction([
+            ("DELETE FROM cache WHERE created_at IS NULL OR created_at < ?", (time.time() - self.ttl,)),
+            (
+                "DELETE FROM cache WHERE hash IN ("
+                "SELECT hash FROM cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.db_max_rows,)
+            ),
+        ])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions,
+            "mem_items": len(self._mem),
+        }
+
+
+result_cache = ResultCache()
+
+
+async def cache_get(key: str):
+    """Получить значение из кэша; попадание учитывается в token_meter по модели и версии промпта."""
+    value = await result_cache.get(key)
+    if value is not None:
+        model, _, version = key.split(":", 1)[0].partition("|")
+        token_meter.cache_hit(model, version or "-")
+    return value
+
+
+async def cache_set(key: str, value: str):
     """Сохранить результат в кэше."""
-    cursor.execute("INSERT OR REPLACE INTO cache (hash, result) VALUES (?, ?)", (key, value))
-    conn.commit()
+    await result_cache.set(key, value)
 
 
-def save_meal(user_id, desc, kcal, p, f, c):
-    now = datetime.now()
-    cursor.execute(
+# ======================================
+# 🖼️ Поиск похожих фото (перцептивный хэш)
+# ======================================
+
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))  # макс. расстояние Хэмминга (из 64 бит)
+PHASH_GLOBAL = os.getenv("PHASH_GLOBAL", "0") == "1"            # 1 — брать и чужие анализы (похожее фото другого пользователя)
+PHASH_DB_MAX_ROWS = int(os.getenv("PHASH_DB_MAX_ROWS", "50000"))  # лимит таблицы photo_hashes (TTL — общий CACHE_TTL)
+
+
+def dhash(image_bytes: bytes, size: int = 8) -> int:
+    """64-битный dHash: сравнение соседних пикселей уменьшенного ч/б изображения."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("L", (size * 4, size * 4))  # JPEG декодируется сразу в уменьшенном виде
+        pixels = list(img.convert("L").resize((size + 1, size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class MultiIndexHash:
+    """Multi-index hashing: 64-битный хэш режется на 4 части по 16 бит.
+
+    Если расстояние Хэмминга ≤ radius, то хотя бы одна часть отличается
+    не больше чем на radius // 4 бит — кандидатов ищем только в этих корзинах.
+    """
+
+    CHUNKS = 4
+    BITS = 16
+
+    def __init__(self):
+        self.tables = [{} for _ in range(self.CHUNKS)]  # chunk -> [(hash, id), ...]
+        self.size = 0
+        self._masks = {}
+
+    def _chunks(self, h: int):
+        mask = (1 << self.BITS) - 1
+        return [(h >> (i * self.BITS)) & mask for i in range(self.CHUNKS)]
+
+    def _flip_masks(self, radius: int):
+        """Все маски из 16 бит, в которых не больше radius единиц."""
+        if radius not in self._masks:
+            masks = [0]
+            for _ in range(radius):
+                masks = list({m | (1 << b) for m in masks for b in range(self.BITS)} | set(masks))
+            self._masks[radius] = masks
+        return self._masks[radius]
+
+    def add(self, h: int, item_id: int):
+        for table, chunk in zip(self.tables, self._chunks(h)):
+            table.setdefault(chunk, []).append((h, item_id))
+        self.size += 1
+
+    def search(self, h: int, radius: int):
+        """Вернуть [(distance, id), ...] всех хэшей не дальше radius."""
+        flips = self._flip_masks(radius // self.CHUNKS)
+        found = {}
+        for table, chunk in zip(self.tables, self._chunks(h)):
+            for m in flips:
+                for other, item_id in table.get(chunk ^ m, ()):
+                    if item_id not in found:
+                        d = (other ^ h).bit_count()
+                        if d <= radius:
+                            found[item_id] = d
+        return sorted((d, i) for i, d in found.items())
+
+
+def _to_sqlite_int(h: int) -> int:
+    """SQLite хранит только знаковые 64-битные числа."""
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+class PhotoIndex:
+    """Индекс перцептивных хэшей уже проанализированных фото."""
+
+    def __init__(self, max_distance=PHASH_MAX_DISTANCE, search_global=PHASH_GLOBAL,
+                 ttl=CACHE_TTL, db_max_rows=PHASH_DB_MAX_ROWS):
+        self.max_distance = max_distance
+        self.search_global = search_global
+        self.ttl = ttl
+        self.db_max_rows = db_max_rows
+        self.tree = MultiIndexHash()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    async def load(self, log=True):
+        """Почистить таблицу photo_hashes и загрузить оставшиеся хэши в индекс."""
+        await self._prune_db(wait=True)
+        tree = MultiIndexHash()
+        for row_id, h in await db.fetchall(
+            "SELECT id, phash FROM photo_hashes WHERE created_at >= ?", (time.time() - self.ttl,)
+        ):
+            tree.add(h & ((1 << 64) - 1), row_id)
+        self.tree = tree
+        if log:
+            logging.info(f"🖼️ Индекс похожих фото: {self.tree.size} хэшей")
+
+    async def find(self, h: int, user_id: int, model: str):
         """
-        INSERT INTO meals (user_id, description, calories, protein, fat, carbs, date, time)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            user_id,
-            desc,
-            kcal,
-            p,
-            f,
-            c,
-            now.strftime("%Y-%m-%d"),
-            now.strftime("%H:%M")
+        Найти результат анализа похожего фото: сначала своего, затем (опц.) чужого.
+        model — область кэша (cache_scope): модель + версия промпта.
+        """
+        matches = self.tree.search(h, self.max_distance)
+        if matches:
+            ids = [i for _, i in matches[:50]]
+            # просроченные хэши остаются в памяти до пересборки — их отсекает created_at
+            rows = await db.fetchall(
+                f"SELECT id, user_id, result FROM photo_hashes "
+                f"WHERE model=? AND created_at >= ? AND id IN ({','.join('?' * len(ids))})",
+                (model, time.time() - self.ttl, *ids)
+            )
+            rows = {row_id: (uid, result) for row_id, uid, result in rows}
+            best_global = None
+            for _, row_id in matches:
+                if row_id not in rows:
+                    continue
+                uid, result = rows[row_id]
+                if uid == user_id:
+                    self.hits += 1
+                    return result
+                if best_global is None:
+                    best_global = result
+            if best_global is not None and self.search_global:
+                self.hits += 1
+                return best_global
+        self.misses += 1
+        return None
+
+    async def add(self, h: int, user_id: int, model: str, result: str):
+        row_id = await db.execute(
+            "INSERT INTO photo_hashes (user_id, model, phash, result, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, model, _to_sqlite_int(h), result, time.time()),
+            wait=True
         )
+        self.tree.add(h, row_id)
+        self._writes += 1
+        if self.tree.size > self.db_max_rows * 1.1:
+            await self.load(log=False)  # пересобрать индекс в памяти по почищенной таблице
+        elif self._writes % 100 == 0:
+            await self._prune_db()
+
+    async def _prune_db(self, wait=None):
+        """Удаляет хэши старше TTL (как записи кэша) и самые старые сверх лимита."""
+        await db.transaction([
+            ("DELETE FROM photo_hashes WHERE created_at IS NULL OR created_at < ?", (time.time() - self.ttl,)),
+            (
+                "DELETE FROM photo_hashes WHERE id IN ("
+                "SELECT id FROM photo_hashes ORDER BY id DESC LIMIT -1 OFFSET ?)",
+                (self.db_max_rows,)
+            ),
+        ], wait=wait)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "hashes": self.tree.size,
+        }
+
+
+photo_index = PhotoIndex()
+
+
+# ======================================
+# 📐 Подготовка фото для Gemini (размер и качество по тарифу)
+# ======================================
+
+# длинная сторона изображения, которой достаточно модели, и качество JPEG при пережатии
+PHOTO_TARGET_PX = {
+    True: int(os.getenv("PHOTO_TARGET_PX_PREMIUM", "1024")),
+    False: int(os.getenv("PHOTO_TARGET_PX_FREE", "768")),
+}
+PHOTO_JPEG_QUALITY = {
+    True: int(os.getenv("PHOTO_JPEG_QUALITY_PREMIUM", "85")),
+    False: int(os.getenv("PHOTO_JPEG_QUALITY_FREE", "75")),
+}
+PHOTO_RESIZE_WORKERS = int(os.getenv("PHOTO_RESIZE_WORKERS", "2"))  # 0 — пережимать в потоке
+PHOTO_RESIZE_SLACK = float(os.getenv("PHOTO_RESIZE_SLACK", "1.1"))  # не пережимать, если больше лимита не более чем на 10%
+
+_resize_pool = None
+
+
+def pick_photo_size(sizes, target_px):
+    """Самый маленький PhotoSize, у которого длинная сторона не меньше target_px (иначе самый большой)."""
+    for size in sorted(sizes, key=lambda s: max(s.width, s.height)):
+        if max(size.width, size.height) >= target_px:
+            return size
+    return max(sizes, key=lambda s: max(s.width, s.height))
+
+
+def start_resize_pool():
+    """
+    Запустить процессы пережатия фото. Вызывается до asyncio.run(main()): процесс ещё однопоточный
+    (нет потоков БД и gRPC-канала Gemini), поэтому воркеры безопасно получаются через fork
+    и не импортируют taste.py заново, как при spawn/forkserver (Database(), миграции, Bot…).
+    """
+    global _resize_pool
+    if Image is None or PHOTO_RESIZE_WORKERS <= 0 or _resize_pool is not None:
+        return
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return  # без fork пережимаем в потоке
+    _resize_pool = ProcessPoolExecutor(
+        max_workers=PHOTO_RESIZE_WORKERS, mp_context=multiprocessing.get_context("fork")
     )
-    conn.commit()
+    # все воркеры — сейчас: иначе пул дозапускает их по требованию, когда потоки уже работают
+    for future in [_resize_pool.submit(imaging.warm_up) for _ in range(PHOTO_RESIZE_WORKERS)]:
+        future.result()
 
 
-def get_stats(user_id):
+async def prepare_image(image_bytes: bytes, premium: bool, longest_side: int = None) -> bytes:
+    """
+    Байты для загрузки в Gemini: при необходимости пережатые в отдельном процессе.
+    longest_side — длинная сторона выбранного PhotoSize: если она уже в пределах лимита тарифа
+    (с запасом PHOTO_RESIZE_SLACK — Telegram отдаёт 800 px при лимите 768), фото уходит как есть.
+    """
+    target_px = PHOTO_TARGET_PX[premium]
+    if Image is None or (longest_side is not None and longest_side <= target_px * PHOTO_RESIZE_SLACK):
+        return image_bytes
+    args = (image_bytes, target_px, PHOTO_JPEG_QUALITY[premium])
+    try:
+        if _resize_pool is not None:
+            return await asyncio.get_running_loop().run_in_executor(_resize_pool, imaging.downscale_jpeg, *args)
+        return await asyncio.to_thread(imaging.downscale_jpeg, *args)
+    except Exception:
+        logging.exception("Не удалось уменьшить фото — отправляю как есть")
+        return image_bytes
+
+
+# ======================================
+# ⚙️ Вспомогательные функции
+# ======================================
+
+# сумма за неделю/месяц растёт вместе с дневной; days — число дней с записями в периоде
+PERIOD_UPSERT = """
+    INSERT INTO period_totals (user_id, kind, period, kcal, p, f, c, days)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT(user_id, kind, period) DO UPDATE SET
+        kcal = kcal + excluded.kcal,
+        p = p + excluded.p,
+        f = f + excluded.f,
+        c = c + excluded.c,
+        days = (SELECT COUNT(*) FROM daily_totals WHERE user_id = ? AND date BETWEEN ? AND ?)
+"""
+
+
+async def save_meal(user_id, desc, kcal, p, f, c):
+    now = datetime.now()
+    day = now.strftime("%Y-%m-%d")
+    # приём пищи и дневная сумма пишутся одной транзакцией;
+    # страницы /history сбрасываем после COMMIT — раньше их успело бы снова закэшировать чтение без новой записи
+    await db.transaction([
+        (
+            """
+            INSERT INTO meals (user_id, description, calories, protein, fat, carbs, date, time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                user_id,
+                desc,
+                kcal,
+                p,
+                f,
+                c,
+                day,
+                now.strftime("%H:%M")
+            )
+        ),
+        (
+            """
+            INSERT INTO daily_totals (user_id, date, kcal, p, f, c, meal_count)
+            VALUES (?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(user_id, date) DO UPDATE SET
+                kcal = kcal + excluded.kcal,
+                p = p + excluded.p,
+                f = f + excluded.f,
+                c = c + excluded.c,
+                meal_count = meal_count + 1
+            """,
+            (user_id, day, kcal, p, f, c)
+        ),
+        *(
+            (PERIOD_UPSERT, (user_id, kind, period_key(kind, now.date()), kcal, p, f, c,
+                             user_id, *(d.isoformat() for d in period_bounds(kind, now.date()))))
+            for kind in ("week", "month")
+        ),
+    ], on_commit=lambda: invalidate_history(user_id))
+
+
+async def get_stats(user_id):
     """Получить статистику за текущий день."""
-    cursor.execute(
-        "SELECT SUM(calories), SUM(protein), SUM(fat), SUM(carbs) FROM meals WHERE user_id=? AND date=?",
+    row = await db.fetchone(
+        "SELECT kcal, p, f, c FROM daily_totals WHERE user_id=? AND date=?",
         (user_id, date.today().isoformat())
     )
-    return cursor.fetchone() or (0, 0, 0, 0)
+    return row or (0, 0, 0, 0)
+
+
+USER_COLUMNS = ("user_id", "is_premium", "last_date", "photos_today", "premium_until")
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))  # страховка на случай записи другим процессом
 
+_user_cache = OrderedDict()  # user_id -> (loaded_at, row)
 
-def get_user(user_id):
+
+def _remember_user(user):
+    _user_cache[user[0]] = (time.monotonic(), user)
+    _user_cache.move_to_end(user[0])
+    while len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+
+
+def invalidate_user(user_id):
+    """Сбросить запись пользователя из кэша (следующее чтение пойдёт в БД)."""
+    _user_cache.pop(user_id, None)
+
+
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "1000"))
+
+_history_pages = OrderedDict()  # user_id -> {ключ страницы: (текст, клавиатура)}
+
+
+def invalidate_history(user_id):
+    """Новая запись в meals — отрисованные страницы /history пользователя устарели."""
+    _history_pages.pop(user_id, None)
+
+
+async def get_user(user_id):
     """Получить данные пользователя или создать нового."""
-    cursor.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    user = cursor.fetchone()
+    cached = _user_cache.get(user_id)
+    if cached is not None and time.monotonic() - cached[0] < USER_CACHE_TTL:
+        _user_cache.move_to_end(user_id)
+        return cached[1]
+
+    user = await db.fetchone(f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id=?", (user_id,))
     if not user:
-        cursor.execute(
-            "INSERT INTO users (user_id, is_premium, last_date, photos_today, premium_until) VALUES (?, 0, ?, 0, NULL)",
+        await db.execute(
+            "INSERT OR IGNORE INTO users (user_id, is_premium, last_date, photos_today, premium_until) VALUES (?, 0, ?, 0, NULL)",
             (user_id, date.today().isoformat())
         )
-        conn.commit()
-        return (user_id, 0, date.today().isoformat(), 0, None)
+        user = (user_id, 0, date.today().isoformat(), 0, None)
+    _remember_user(user)
     return user
 
 
-def update_user(user_id, **fields):
-    """Обновить данные пользователя."""
+async def update_user(user_id, **fields):
+    """Обновить данные пользователя (write-through: кэш и БД)."""
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        row = dict(zip(USER_COLUMNS, cached[1]))
+        row.update(fields)
+        _remember_user(tuple(row[c] for c in USER_COLUMNS))
+
     set_clause = ", ".join([f"{k}=?" for k in fields.keys()])
-    cursor.execute(f"UPDATE users SET {set_clause} WHERE user_id=?", (*fields.values(), user_id))
-    conn.commit()
+    await db.execute(f"UPDATE users SET {set_clause} WHERE user_id=?", (*fields.values(), user_id))
 
 
-def is_premium_active(user_id):
-    """Проверить, активен ли Premium."""
-    user = get_user(user_id)
+async def set_premium(user_id, is_premium, premium_until):
+    """Изменить статус Premium (Stripe, админ-код): дожидаемся COMMIT и сбрасываем кэш."""
+    await db.execute(
+        "UPDATE users SET is_premium=?, premium_until=? WHERE user_id=?",
+        (is_premium, premium_until, user_id),
+        wait=True
+    )
+    invalidate_user(user_id)
+    if is_premium:
+        await summary_scheduler.refresh(user_id)
+
+
+def premium_active(user):
+    """Активен ли Premium по уже загруженной записи пользователя."""
     is_premium, premium_until = user[1], user[4]
     if is_premium:
         if not premium_until:
@@ -181,30 +1089,44 @@ def is_premium_active(user_id):
     return False
 
 
-def increment_photo(user_id):
-    """Увеличить счётчик фото за день."""
-    user_id, is_premium, last_date, photos_today, premium_until = get_user(user_id)
+async def is_premium_active(user_id):
+    """Проверить, активен ли Premium."""
+    return premium_active(await get_user(user_id))
+
+
+async def increment_photo(user_id, count=1):
+    """Увеличить счётчик фото за день на count (альбом — по числу фото)."""
+    user_id, is_premium, last_date, photos_today, premium_until = await get_user(user_id)
     today = date.today().isoformat()
-    if last_date != today:
-        update_user(user_id, last_date=today, photos_today=0)
-        photos_today = 0
-    photos_today += 1
-    update_user(user_id, photos_today=photos_today)
+    photos_today = photos_today + count if last_date == today else count
+    _remember_user((user_id, is_premium, today, photos_today, premium_until))
+    # в БД — приращение, а не значение из кэша: кэш мог отстать от записи другим процессом
+    await db.execute(
+        "UPDATE users SET photos_today = CASE WHEN last_date = ? THEN photos_today + ? ELSE ? END, last_date = ? "
+        "WHERE user_id = ?",
+        (today, count, count, today, user_id),
+    )
     return photos_today
 
 
-def can_analyze_photo(user_id):
+FREE_PHOTOS_PER_DAY = 2
+
+
+def photos_left(user, premium):
+    """Сколько фото ещё можно отправить сегодня; None — без лимита (Premium)."""
+    user_id, is_premium, last_date, photos_today, premium_until = user
+    if premium:
+        return None
+    if last_date != date.today().isoformat():
+        return FREE_PHOTOS_PER_DAY  # новый день — счётчик обнулит increment_photo
+    return max(0, FREE_PHOTOS_PER_DAY - photos_today)
+
+
+async def can_analyze_photo(user, premium):
     """Проверить, может ли пользователь отправить фото (лимит)."""
-    user_id, is_premium, last_date, photos_today, premium_until = get_user(user_id)
-    if is_premium_active(user_id):
-        return True, None
-    today = date.today().isoformat()
-    if last_date != today:
-        update_user(user_id, last_date=today, photos_today=0)
-        return True, None
-    if photos_today >= 2:
+    if photos_left(user, premium) == 0:
         return False, (
-            "📸 Сегодня лимит 2 фото.\n\n"
+            f"📸 Сегодня лимит {FREE_PHOTOS_PER_DAY} фото.\n\n"
             "💎 *TasteBalance Premium* — без ограничений и с точным анализом.\n"
             "Нажми «Получить Premium» ниже 👇"
         )
@@ -212,30 +1134,1246 @@ def can_analyze_photo(user_id):
 
 
 # ======================================
-# 🔮 Промпт для анализа изображения
+# 🧾 Состояние диалогов (редактирование, ручной ввод, отзывы)
+# ======================================
+
+WORKFLOW_IDLE_TTL = int(os.getenv("WORKFLOW_IDLE_TTL", str(24 * 3600)))  # забываем после суток тишины
+WORKFLOW_MEM_MAX = int(os.getenv("WORKFLOW_MEM_MAX", "5000"))            # остальное — только в SQLite
+WORKFLOW_SPILL = os.getenv("WORKFLOW_SPILL", "1") == "1"                 # хранить копию в SQLite
+
+
+def _num(value):
+    """Число из ответа модели: '150', 150.0, None → 150, 150, 0."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return int(value) if value.is_integer() else value
+
+
+class MealItem:
+    """Ингредиент блюда."""
+
+    __slots__ = ("name", "weight_g", "cal", "protein", "fat", "carbs")
+
+    def __init__(self, name, weight_g=0, cal=0, protein=0, fat=0, carbs=0):
+        self.name = name
+        self.weight_g = weight_g
+        self.cal = cal
+        self.protein = protein
+        self.fat = fat
+        self.carbs = carbs
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            str(d.get("name") or "—"),
+            _num(d.get("weight_g")),
+            _num(d.get("cal")),
+            _num(d.get("protein")),
+            _num(d.get("fat")),
+            _num(d.get("carbs")),
+        )
+
+    def to_list(self):
+        return [self.name, self.weight_g, self.cal, self.protein, self.fat, self.carbs]
+
+
+class Meal:
+    """Блюдо: ингредиенты и итоговое КБЖУ."""
+
+    __slots__ = ("items", "cal", "protein", "fat", "carbs")
+
+    def __init__(self, items, total=None):
+        self.items = items
+        if total is None:
+            self.recalc()
+        else:
+            self.cal, self.protein, self.fat, self.carbs = total
+
+    @classmethod
+    def from_dict(cls, data):
+        """Из JSON модели: {"items": [...], "total": {...}}."""
+        items = [MealItem.from_dict(i) for i in data.get("items") or [] if isinstance(i, dict)]
+        total = data.get("total")
+        if isinstance(total, dict) and total:
+            return cls(items, (_num(total.get("cal")), _num(total.get("protein")),
+                               _num(total.get("fat")), _num(total.get("carbs"))))
+        return cls(items)
+
+    def recalc(self):
+        """Пересчитать итог по ингредиентам."""
+        self.cal = round(sum(i.cal for i in self.items), 2)
+        self.protein = round(sum(i.protein for i in self.items), 2)
+        self.fat = round(sum(i.fat for i in self.items), 2)
+        self.carbs = round(sum(i.carbs for i in self.items), 2)
+
+    def description(self):
+        return ", ".join(i.name for i in self.items)
+
+    def to_dict(self):
+        """Обратно в формат ответа модели — так блюдо хранится в кэше."""
+        return {
+            "items": [dict(zip(MealItem.__slots__, i.to_list())) for i in self.items],
+            "total": {"cal": self.cal, "protein": self.protein, "fat": self.fat, "carbs": self.carbs},
+        }
+
+
+class Workflow:
+    """Состояние диалога пользователя."""
+
+    __slots__ = ("mode", "stage", "editing_index", "meal", "touched")
+
+    def __init__(self, mode=None, meal=None, stage=None, editing_index=None):
+        self.mode = mode
+        self.stage = stage
+        self.editing_index = editing_index
+        self.meal = meal
+        self.touched = time.time()
+
+    def dump(self):
+        meal = None
+        if self.meal is not None:
+            meal = [[i.to_list() for i in self.meal.items],
+                    [self.meal.cal, self.meal.protein, self.meal.fat, self.meal.carbs]]
+        return json.dumps([self.mode, self.stage, self.editing_index, meal], ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, raw):
+        mode, stage, editing_index, meal = json.loads(raw)
+        if meal is not None:
+            meal = Meal([MealItem(*i) for i in meal[0]], tuple(meal[1]))
+        return cls(mode, meal, stage, editing_index)
+
+
+class WorkflowStore:
+    """Состояния диалогов: LRU в памяти с TTL простоя + (опц.) копия в SQLite.
+
+    После изменения состояния нужно вызвать `await workflows.save(user_id, wf)` —
+    тогда оно попадёт в SQLite и переживёт передеплой.
+    """
+
+    def __init__(self, idle_ttl=WORKFLOW_IDLE_TTL, mem_max=WORKFLOW_MEM_MAX, spill=WORKFLOW_SPILL):
+        self.idle_ttl = idle_ttl
+        self.mem_max = mem_max
+        self.spill = spill
+        self._mem = OrderedDict()  # user_id -> Workflow
+        self.loaded_from_db = 0
+        self.expired = 0
+
+    async def get(self, user_id):
+        wf = self._mem.get(user_id)
+        if wf is None and self.spill:
+            row = await db.fetchone("SELECT data, updated_at FROM workflow_state WHERE user_id=?", (user_id,))
+            if row and time.time() - row[1] < self.idle_ttl:
+                wf = Workflow.load(row[0])
+                wf.touched = row[1]
+                self.loaded_from_db += 1
+                self._put(user_id, wf)
+        if wf is None:
+            return None
+        if time.time() - wf.touched > self.idle_ttl:
+            await self.pop(user_id)
+            self.expired += 1
+            return None
+        self._mem.move_to_end(user_id)
+        return wf
+
+    async def save(self, user_id, wf):
+        wf.touched = time.time()
+        self._put(user_id, wf)
+        if self.spill:
+            await db.execute(
+                "INSERT OR REPLACE INTO workflow_state (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (user_id, wf.dump(), wf.touched)
+            )
+
+    async def pop(self, user_id):
+        self._mem.pop(user_id, None)
+        if self.spill:
+            await db.execute("DELETE FROM workflow_state WHERE user_id=?", (user_id,))
+
+    def _put(self, user_id, wf):
+        self._mem[user_id] = wf
+        self._mem.move_to_end(user_id)
+        while len(self._mem) > self.mem_max:
+            self._mem.popitem(last=False)  # при spill копия остаётся в SQLite
+
+    async def evict_idle(self):
+        """Удалить состояния, простаивающие дольше TTL, из памяти и SQLite."""
+        deadline = time.time() - self.idle_ttl
+        while self._mem:
+            user_id, wf = next(iter(self._mem.items()))
+            if wf.touched > deadline:
+                break
+            self._mem.popitem(last=False)
+            self.expired += 1
+        if self.spill:
+            await db.execute("DELETE FROM workflow_state WHERE updated_at < ?", (deadline,))
+
+    def memory_usage(self):
+        """Примерный объём состояний в памяти (байты, по sys.getsizeof)."""
+        total = sys.getsizeof(self._mem)
+        for wf in self._mem.values():
+            total += sys.getsizeof(wf)
+            if wf.meal is not None:
+                total += sys.getsizeof(wf.meal) + sys.getsizeof(wf.meal.items)
+                total += sum(sys.getsizeof(i) + sys.getsizeof(i.name) for i in wf.meal.items)
+        return {"entries": len(self._mem), "bytes": total, "loaded_from_db": self.loaded_from_db, "expired": self.expired}
+
+
+workflows = WorkflowStore()
+
+
+async def workflow_janitor(interval=600):
+    """Периодически выбрасывать простаивающие состояния диалогов."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await workflows.evict_idle()
+            logging.info(f"🧾 Состояния диалогов: {workflows.memory_usage()}")
+        except Exception:
+            logging.exception("Ошибка очистки состояний диалогов")
+
+
+# ======================================
+# 🔮 Промпты
 # ======================================
 
-ANALYSIS_PROMPT = """
-Ты — эксперт по питанию и анализу изображений еды.
-Проанализируй фото и верни JSON строго по формату.
+PROMPT_VARIANT = os.getenv("PROMPT_VARIANT", "")  # full / compact; пусто — compact для *-lite, full для остальных
+
+_formatter = string.Formatter()
+
+
+class PromptTemplate:
+    """Шаблон промпта: разбирается один раз при загрузке, на вызове — только склейка кусков."""
+
+    __slots__ = ("kind", "version", "_parts")
+
+    def __init__(self, kind, version, *chunks):
+        self.kind = kind
+        self.version = version
+        text = "\n".join(textwrap.dedent(chunk).strip() for chunk in chunks)
+        self._parts = [(literal, field) for literal, field, _, _ in _formatter.parse(text)]
 
-⚙️ Правила:
-- Определи все видимые ингредиенты и блюда (по отдельности).
-- Не добавляй несуществующие продукты.
-- Для каждого ингредиента оцени примерный вес (целое число).
-- Рассчитай КБЖУ (калории, белки, жиры, углеводы) максимально реалистично.
-- Не пиши лишний текст, комментарии и описания.
+    def render(self, **values):
+        return "".join(literal + (str(values[field]) if field is not None else "") for literal, field in self._parts)
 
-📋 Формат ответа строго:
-{
+
+_MEAL_EXAMPLE = """
+{{
   "items": [
-    {"name": "курица", "weight_g": 150, "cal": 230, "protein": 32, "fat": 5, "carbs": 0},
-    {"name": "рис", "weight_g": 200, "cal": 260, "protein": 6, "fat": 2, "carbs": 56}
+    {{"name": "курица", "weight_g": 150, "cal": 230, "protein": 32, "fat": 5, "carbs": 0}},
+    {{"name": "рис", "weight_g": 200, "cal": 260, "protein": 6, "fat": 2, "carbs": 56}}
   ],
-  "total": {"cal": 490, "protein": 38, "fat": 7, "carbs": 56}
-}
+  "total": {{"cal": 490, "protein": 38, "fat": 7, "carbs": 56}}
+}}
 """
 
+_MEAL_COMPACT = (
+    'JSON: {{"items":[{{"name","weight_g","cal","protein","fat","carbs"}}],'
+    '"total":{{"cal","protein","fat","carbs"}}}}, числа без единиц.'
+)
+
+PROMPTS = {
+    ("photo", "full"): PromptTemplate("photo", "photo/full-1", """
+        Ты — эксперт по питанию и анализу изображений еды.
+        Проанализируй фото и верни JSON строго по формату.
+
+        ⚙️ Правила:
+        - Определи все видимые ингредиенты и блюда (по отдельности).
+        - Не добавляй несуществующие продукты.
+        - Для каждого ингредиента оцени примерный вес (целое число).
+        - Рассчитай КБЖУ (калории, белки, жиры, углеводы) максимально реалистично.
+        - Не пиши лишний текст, комментарии и описания.
+
+        📋 Формат ответа строго:
+    """, _MEAL_EXAMPLE),
+    ("photo", "compact"): PromptTemplate("photo", "photo/compact-1", """
+        Еда на фото: каждый видимый продукт отдельно, вес в граммах целым числом, реалистичное КБЖУ.
+    """, _MEAL_COMPACT),
+
+    ("album", "full"): PromptTemplate("album", "album/full-1", """
+        Ты — эксперт по питанию и анализу изображений еды.
+        На нескольких фото — блюда одного приёма пищи. Проанализируй все фото и верни один JSON.
+
+        ⚙️ Правила:
+        - Перечисли ингредиенты со всех фото (по отдельности), одно и то же блюдо на разных фото — один раз.
+        - Не добавляй несуществующие продукты.
+        - Для каждого ингредиента оцени примерный вес (целое число).
+        - Рассчитай КБЖУ (калории, белки, жиры, углеводы) максимально реалистично, total — по всем фото.
+        - Не пиши лишний текст, комментарии и описания.
+
+        📋 Формат ответа строго:
+    """, _MEAL_EXAMPLE),
+    ("album", "compact"): PromptTemplate("album", "album/compact-1", """
+        Несколько фото одного приёма пищи: продукты со всех фото, повторы — один раз, вес в граммах, реалистичное КБЖУ, total по всем.
+    """, _MEAL_COMPACT),
+
+    ("manual", "full"): PromptTemplate("manual", "manual/full-1", """
+        Ты — эксперт по питанию. Пользователь описал блюдо:
+        "{text}"
+
+        Определи ингредиенты, примерный вес и рассчитай КБЖУ.
+        Ответ строго в JSON формате, как в примере:
+    """, _MEAL_EXAMPLE),
+    ("manual", "compact"): PromptTemplate("manual", "manual/compact-1", """
+        Блюдо: "{text}". Ингредиенты, вес в граммах, реалистичное КБЖУ.
+    """, _MEAL_COMPACT),
+
+    ("rename", "full"): PromptTemplate("rename", "rename/full-1", """
+        Ты — эксперт по питанию. Определи КБЖУ для продукта "{name}" в количестве {weight} г.
+        Ответ строго в JSON формате:
+        {{
+          "cal": число,
+          "protein": число,
+          "fat": число,
+          "carbs": число
+        }}
+    """),
+    ("rename", "compact"): PromptTemplate("rename", "rename/compact-1", """
+        КБЖУ для "{name}", {weight} г. JSON: {{"cal","protein","fat","carbs"}}, числа.
+    """),
+}
+
+
+def get_prompt(kind, model):
+    """Вариант промпта для модели: PROMPT_VARIANT, иначе компактный для flash-lite."""
+    variant = PROMPT_VARIANT or ("compact" if model.endswith("-lite") else "full")
+    return PROMPTS.get((kind, variant)) or PROMPTS[(kind, "full")]
+
+
+def prompt_contents(kind, *attachments, **values):
+    """Сборщик запроса для gemini_resilient: промпт под конкретную модель и вложения (фото)."""
+    def build(model):
+        prompt = get_prompt(kind, model)
+        return [prompt.render(**values), *attachments], prompt
+    return build
+
+
+# ======================================
+# 🥗 Локальная таблица КБЖУ (на 100 г)
+# ======================================
+
+# ккал, белки, жиры, углеводы на 100 г готового продукта
+NUTRITION_PER_100G = {
+    "курица": (190, 27, 8.5, 0),
+    "куриная грудка": (165, 31, 3.6, 0),
+    "куриное бедро": (209, 26, 10.9, 0),
+    "индейка": (150, 29, 3, 0),
+    "говядина": (250, 26, 15, 0),
+    "свинина": (242, 27, 14, 0),
+    "баранина": (294, 25, 21, 0),
+    "фарш": (254, 17, 20, 0),
+    "котлета": (260, 15, 18, 10),
+    "сосиски": (260, 11, 23, 2),
+    "колбаса": (257, 13, 22, 1.5),
+    "ветчина": (145, 21, 6, 1.5),
+    "бекон": (541, 37, 42, 1.4),
+    "лосось": (208, 20, 13, 0),
+    "тунец": (132, 28, 1.3, 0),
+    "треска": (82, 18, 0.7, 0),
+    "креветки": (99, 24, 0.3, 0.2),
+    "яйцо": (155, 13, 11, 1.1),
+    "омлет": (154, 11, 12, 1),
+    "рис": (130, 2.7, 0.3, 28),
+    "гречка": (110, 4.2, 1.1, 21),
+    "овсянка": (88, 3, 1.7, 15),
+    "пшено": (119, 3.5, 1, 23),
+    "булгур": (83, 3.1, 0.2, 19),
+    "киноа": (120, 4.4, 1.9, 21),
+    "макароны": (158, 5.8, 0.9, 31),
+    "картофель": (87, 1.9, 0.1, 20),
+    "картофельное пюре": (106, 2, 4, 15),
+    "картофель фри": (312, 3.4, 15, 41),
+    "хлеб": (265, 9, 3.2, 49),
+    "ржаной хлеб": (259, 8.5, 3.3, 48),
+    "лаваш": (275, 9, 1, 56),
+    "блины": (233, 6, 12, 26),
+    "сыр": (350, 25, 27, 0),
+    "творог": (121, 17, 5, 1.8),
+    "молоко": (52, 2.9, 2.5, 4.7),
+    "кефир": (51, 2.9, 2.5, 4),
+    "йогурт": (60, 4, 2, 6),
+    "сметана": (206, 2.8, 20, 3.2),
+    "сливочное масло": (717, 0.9, 81, 0.1),
+    "оливковое масло": (884, 0, 100, 0),
+    "подсолнечное масло": (884, 0, 100, 0),
+    "майонез": (680, 1, 75, 2.6),
+    "кетчуп": (101, 1, 0.1, 27),
+    "огурец": (15, 0.7, 0.1, 3.6),
+    "помидор": (18, 0.9, 0.2, 3.9),
+    "морковь": (41, 0.9, 0.2, 10),
+    "капуста": (25, 1.3, 0.1, 5.8),
+    "брокколи": (34, 2.8, 0.4, 7),
+    "салат": (15, 1.4, 0.2, 2.9),
+    "лук": (40, 1.1, 0.1, 9.3),
+    "болгарский перец": (26, 1, 0.3, 6),
+    "кабачок": (17, 1.2, 0.3, 3.1),
+    "баклажан": (25, 1, 0.2, 6),
+    "шампиньоны": (22, 3.1, 0.3, 3.3),
+    "авокадо": (160, 2, 15, 9),
+    "кукуруза": (96, 3.4, 1.5, 21),
+    "фасоль": (127, 8.7, 0.5, 23),
+    "чечевица": (116, 9, 0.4, 20),
+    "нут": (164, 8.9, 2.6, 27),
+    "банан": (89, 1.1, 0.3, 23),
+    "яблоко": (52, 0.3, 0.2, 14),
+    "апельсин": (47, 0.9, 0.1, 12),
+    "мандарин": (53, 0.8, 0.3, 13),
+    "груша": (57, 0.4, 0.1, 15),
+    "виноград": (69, 0.7, 0.2, 18),
+    "клубника": (32, 0.7, 0.3, 7.7),
+    "черника": (57, 0.7, 0.3, 14),
+    "киви": (61, 1.1, 0.5, 15),
+    "арбуз": (30, 0.6, 0.2, 7.6),
+    "грецкие орехи": (654, 15, 65, 14),
+    "миндаль": (579, 21, 50, 22),
+    "арахис": (567, 26, 49, 16),
+    "арахисовая паста": (588, 25, 50, 20),
+    "мед": (304, 0.3, 0, 82),
+    "сахар": (387, 0, 0, 100),
+    "шоколад": (546, 4.9, 31, 61),
+    "печенье": (417, 7.5, 12, 70),
+    "пицца": (266, 11, 10, 33),
+    "борщ": (57, 2.7, 3.3, 4.3),
+    "пельмени": (275, 12, 13, 29),
+}
+
+# другие названия тех же продуктов
+NUTRITION_ALIASES = {
+    "куриное филе": "куриная грудка",
+    "филе курицы": "куриная грудка",
+    "курица гриль": "курица",
+    "семга": "лосось",
+    "яйца": "яйцо",
+    "вареное яйцо": "яйцо",
+    "рис отварной": "рис",
+    "гречневая каша": "гречка",
+    "овсяная каша": "овсянка",
+    "овсяные хлопья": "овсянка",
+    "спагетти": "макароны",
+    "паста": "макароны",
+    "картошка": "картофель",
+    "пюре": "картофельное пюре",
+    "батон": "хлеб",
+    "белый хлеб": "хлеб",
+    "черный хлеб": "ржаной хлеб",
+    "томат": "помидор",
+    "помидоры": "помидор",
+    "огурцы": "огурец",
+    "грибы": "шампиньоны",
+    "масло": "сливочное масло",
+    "растительное масло": "подсолнечное масло",
+    "орехи": "грецкие орехи",
+    "греческий йогурт": "йогурт",
+}
+
+NUTRITION_MIN_SCORE = float(os.getenv("NUTRITION_MIN_SCORE", "0.8"))   # минимальное сходство по триграммам
+NUTRITION_CANDIDATES = int(os.getenv("NUTRITION_CANDIDATES", "8"))        # сколько кандидатов ранжировать по опечаткам
+
+# окончания, которые отбрасываем при стемминге (сначала длинные)
+_RU_ENDINGS = sorted(
+    ("ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ую", "юю", "ой", "ей", "ий", "ый",
+     "ая", "яя", "ое", "ее", "ые", "ие", "ых", "их", "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев",
+     "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й"),
+    key=len, reverse=True,
+)
+
+
+def stem_ru(word):
+    """Грубый стемминг: отрезаем одно падежное окончание, оставляя основу не короче 3 букв."""
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def damerau_levenshtein(a, b, limit=None):
+    """Расстояние Дамерау–Левенштейна (перестановка соседних букв — одна правка); выход по limit."""
+    if a == b:
+        return 0
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if limit is not None and min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class NutritionIndex:
+    """
+    Поиск продукта в локальной таблице.
+    Точное совпадение по названию и по основам слов, затем кандидаты из триграммного индекса,
+    которые ранжируются по расстоянию Дамерау–Левенштейна (опечатки) и коэффициенту Дайса.
+    """
+
+    def __init__(self, table=NUTRITION_PER_100G, aliases=NUTRITION_ALIASES, min_score=NUTRITION_MIN_SCORE):
+        self.table = table
+        self.min_score = min_score
+        self._keys = []      # id -> (основы слов названия, каноническое название)
+        self._exact = {}     # нормализованное название -> id
+        self._stemmed = {}   # основы слов названия -> id
+        self._grams = {}     # триграмма -> [id, ...]
+        self._sizes = []     # id -> число триграмм в названии
+        self.hits = 0
+        self.misses = 0
+        for name in table:
+            self._add(name, name)
+        for alias, name in aliases.items():
+            self._add(alias, name)
+
+    @staticmethod
+    def normalize(text):
+        text = text.lower().replace("ё", "е")
+        return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+    @staticmethod
+    def stems(key):
+        return " ".join(stem_ru(w) for w in key.split())
+
+    @staticmethod
+    def trigrams(text):
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def _add(self, key, canonical):
+        key = self.normalize(key)
+        stemmed = self.stems(key)
+        grams = self.trigrams(stemmed)
+        item_id = len(self._keys)
+        self._keys.append((stemmed, canonical))
+        self._sizes.append(len(grams))
+        self._exact.setdefault(key, item_id)
+        self._stemmed.setdefault(stemmed, item_id)
+        for gram in grams:
+            self._grams.setdefault(gram, []).append(item_id)
+
+    def search(self, name, fuzzy=True):
+        """Каноническое название продукта или None; fuzzy=False — только точное название, основы и синонимы."""
+        key = self.normalize(name)
+        if not key:
+            return None
+        # основы сравниваем только с основами: «печень» → «печен», а не «печень» из «печенье»
+        stemmed = self.stems(key)
+        item_id = self._exact.get(key)
+        if item_id is None:
+            item_id = self._stemmed.get(stemmed)
+        if item_id is not None:
+            return self._keys[item_id][1]
+        if not fuzzy:
+            return None
+
+        grams = self.trigrams(stemmed)
+        shared = {}
+        for gram in grams:
+            for i in self._grams.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        if not shared:
+            return None
+        scored = sorted(
+            ((2 * n / (len(grams) + self._sizes[i]), i) for i, n in shared.items()), reverse=True
+        )[:NUTRITION_CANDIDATES]
+
+        # нужны и близкое написание, и высокое сходство по триграммам;
+        # каждое слово запроса должно найтись в названии продукта («картофель с мясом» ≠ «картофель»)
+        words = stemmed.split()
+        best, best_rank = None, None
+        for dice, i in scored:
+            if dice < self.min_score:
+                break
+            dist = self._covered(words, self._keys[i][0].split())
+            if dist is None:
+                continue
+            rank = (dist, -dice)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = i, rank
+        return self._keys[best][1] if best is not None else None
+
+    @staticmethod
+    def typo_limit(word):
+        """Сколько опечаток допускаем в основе: в коротких (пиво/киви) — ни одной, дальше одну на четыре буквы."""
+        return 0 if len(word) <= 4 else max(1, len(word) // 4)
+
+    def _covered(self, words, candidate):
+        """Суммарное число опечаток, если каждое слово запроса есть в названии кандидата, иначе None."""
+        total = 0
+        for word in words:
+            limit = self.typo_limit(word)
+            dist = min(damerau_levenshtein(word, other, limit) for other in candidate)
+            if dist > limit:
+                return None
+            total += dist
+        return total
+
+    def lookup(self, name, weight_g, fuzzy=True):
+        """КБЖУ продукта на заданный вес: {"cal", "protein", "fat", "carbs"} или None."""
+        canonical = self.search(name, fuzzy)
+        if canonical is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        factor = (weight_g or 0) / 100
+        cal, p, f, c = self.table[canonical]
+        return {
+            "cal": round(cal * factor, 1),
+            "protein": round(p * factor, 1),
+            "fat": round(f * factor, 1),
+            "carbs": round(c * factor, 1),
+        }
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+
+nutrition_index = NutritionIndex()
+
+
+# ======================================
+# ✍️ Разбор ручного ввода без Gemini
+# ======================================
+
+# «овсянка 100г», «банан 50 гр», «молоко 0,2 л» — название и вес с единицей
+_MANUAL_ITEM_RE = re.compile(
+    r"\s*(?P<name>[^\d,;+\n]+?)\s*[-—:]?\s*(?P<qty>\d+(?:[.,]\d+)?)\s*"
+    r"(?P<unit>кг|килограмм\w*|гр|грамм\w*|г|g|мл|ml|л)\.?(?=[\s,;+]|$)\s*(?:[,;+]|\bи\b)?",
+    re.IGNORECASE,
+)
+_MANUAL_UNIT_FACTOR = {"кг": 1000, "килограмм": 1000, "л": 1000}
+
+manual_parse_stats = {"local": 0, "gemini": 0}
+
+
+def parse_manual_meal(text, index=None):
+    """
+    Разбирает ввод вида «овсянка 100г банан 50г» целиком по локальной таблице.
+    Возвращает Meal или None, если текст свободный или хоть один продукт не найден —
+    тогда блюдо считает Gemini.
+    """
+    index = index or nutrition_index
+    text = text.strip()
+    items = []
+    pos = 0
+    while pos < len(text):
+        m = _MANUAL_ITEM_RE.match(text, pos)
+        if not m or m.end() == pos:
+            break
+        name = re.sub(r"^(?:и|со|с|\+)\s+", "", m.group("name").strip(), flags=re.IGNORECASE)
+        unit = m.group("unit").lower()
+        factor = next((v for k, v in _MANUAL_UNIT_FACTOR.items() if unit.startswith(k)), 1)
+        weight = _num(round(float(m.group("qty").replace(",", ".")) * factor, 1))
+        data = index.lookup(name, weight) if name and weight > 0 else None
+        if data is None:
+            break
+        items.append(MealItem(name, weight, data["cal"], data["protein"], data["fat"], data["carbs"]))
+        pos = m.end()
+
+    if not items or text[pos:].strip(" ,;.+"):
+        manual_parse_stats["gemini"] += 1
+        return None
+    manual_parse_stats["local"] += 1
+    return Meal(items)
+
+
+# ======================================
+# 🚦 Очередь запросов к Gemini (Premium — вперёд)
+# ======================================
+
+# максимум одновременных запросов к каждой модели; остальные ждут в очереди
+GEMINI_MAX_INFLIGHT = {
+    "gemini-2.5-flash": int(os.getenv("GEMINI_MAX_INFLIGHT_FLASH", "8")),
+    "gemini-2.5-flash-lite": int(os.getenv("GEMINI_MAX_INFLIGHT_LITE", "16")),
+}
+GEMINI_MAX_INFLIGHT_DEFAULT = int(os.getenv("GEMINI_MAX_INFLIGHT_DEFAULT", "8"))
+
+PRIORITY_PREMIUM = 0
+PRIORITY_FREE = 1
+
+
+class InferenceScheduler:
+    """Ограничивает число параллельных запросов к модели и раздаёт слоты по приоритету.
+
+    Очередь у каждой модели своя: heap из (приоритет, порядковый номер, future),
+    так что Premium всегда обслуживается раньше бесплатных, а внутри класса — FIFO.
+    """
+
+    def __init__(self, limits=GEMINI_MAX_INFLIGHT, default_limit=GEMINI_MAX_INFLIGHT_DEFAULT):
+        self.limits = limits
+        self.default_limit = default_limit
+        self._inflight = {}
+        self._waiting = {}
+        self._seq = itertools.count()
+        # метрики
+        self.requests = 0
+        self.queued = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _limit(self, model):
+        return self.limits.get(model, self.default_limit)
+
+    def depth(self, model=None):
+        """Сколько запросов ждёт (по модели или всего)."""
+        if model is not None:
+            return sum(1 for *_, fut in self._waiting.get(model, ()) if not fut.done())
+        return sum(self.depth(m) for m in self._waiting)
+
+    async def acquire(self, model, premium=False, on_queued=None):
+        self.requests += 1
+        heap = self._waiting.setdefault(model, [])
+        if self._inflight.get(model, 0) < self._limit(model) and not heap:
+            self._inflight[model] = self._inflight.get(model, 0) + 1
+            return
+
+        entry = (PRIORITY_PREMIUM if premium else PRIORITY_FREE, next(self._seq),
+                 asyncio.get_running_loop().create_future())
+        heapq.heappush(heap, entry)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, len(heap))
+
+        started = time.monotonic()
+        try:
+            if on_queued is not None:
+                position = sum(1 for e in heap if e[:2] < entry[:2] and not e[2].done()) + 1
+                try:
+                    await on_queued(position)
+                except Exception:
+                    logging.exception("Ошибка уведомления об очереди")
+            await entry[2]
+        except BaseException:
+            # отменили (в том числе пока отправлялось уведомление): запись в heap не должна
+            # получить слот, а уже переданный слот возвращаем
+            if entry[2].done() and not entry[2].cancelled():
+                self.release(model)
+            else:
+                entry[2].cancel()
+            raise
+        waited = time.monotonic() - started
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def release(self, model):
+        """Освободить слот: передать первому ожидающему или уменьшить счётчик."""
+        heap = self._waiting.get(model)
+        while heap:
+            *_, fut = heapq.heappop(heap)
+            if not fut.done():
+                fut.set_result(None)  # слот переходит к следующему без изменения счётчика
+                return
+        self._inflight[model] -= 1
+
+    @asynccontextmanager
+    async def slot(self, model, premium=False, on_queued=None):
+        await self.acquire(model, premium, on_queued)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "queued": self.queued,
+            "inflight": dict(self._inflight),
+            "depth": {m: self.depth(m) for m in self._waiting},
+            "max_depth": self.max_depth,
+            "avg_wait_ms": round(self.wait_total / self.queued * 1000, 1) if self.queued else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 1),
+        }
+
+
+inference = InferenceScheduler()
+
+
+def queue_notice(message: types.Message):
+    """Колбэк для InferenceScheduler: сообщить пользователю его место в очереди."""
+    async def notify(position):
+        await message.answer(f"⏳ Сейчас много запросов — ты в очереди, позиция {position}. Скоро отвечу!")
+    return notify
+
+
+# 1 — нативный async-клиент SDK (gRPC aio, одно соединение на процесс, без потоков);
+# 0 — старый путь через пул потоков (на случай проблем с async-транспортом)
+# асинхронный клиент SDK работает только поверх gRPC; с REST-адресом — синхронный вызов в потоке
+GEMINI_ASYNC = os.getenv("GEMINI_ASYNC", "0" if GEMINI_API_ENDPOINT else "1") == "1"
+
+# сколько секунд ждать ответ модели (очередь планировщика не считается)
+GEMINI_TIMEOUT = {
+    "gemini-2.5-flash": float(os.getenv("GEMINI_TIMEOUT_FLASH", "40")),
+    "gemini-2.5-flash-lite": float(os.getenv("GEMINI_TIMEOUT_LITE", "25")),
+}
+GEMINI_TIMEOUT_DEFAULT = float(os.getenv("GEMINI_TIMEOUT_DEFAULT", "40"))
+
+_gemini_models = {}
+
+
+def get_gemini_model(model):
+    """GenerativeModel создаётся один раз на модель — клиент и соединение переиспользуются."""
+    if model not in _gemini_models:
+        _gemini_models[model] = genai.GenerativeModel(model)
+    return _gemini_models[model]
+
+
+GEMINI_COUNT_TOKENS = os.getenv("GEMINI_COUNT_TOKENS", "1") == "1"  # count_tokens, если SDK не вернул usage_metadata
+TOKEN_LOG_EVERY = int(os.getenv("TOKEN_LOG_EVERY", "200"))            # раз в сколько вызовов писать сводку в лог
+
+
+class TokenMeter:
+    """Токены и время ответа по модели и версии промпта — чтобы сравнивать варианты промптов."""
+
+    def __init__(self):
+        self._rows = {}  # (model, версия промпта) -> [вызовы, вход, выход, секунды]
+        self._hits = {}  # (model, версия промпта) -> ответы из кэша без вызова Gemini
+        self.calls = 0
+
+    def record(self, model, version, input_tokens, output_tokens, seconds):
+        row = self._rows.setdefault((model, version), [0, 0, 0, 0.0])
+        row[0] += 1
+        row[1] += input_tokens or 0
+        row[2] += output_tokens or 0
+        row[3] += seconds
+        self.calls += 1
+        if TOKEN_LOG_EVERY and self.calls % TOKEN_LOG_EVERY == 0:
+            self.log()
+
+    def add_input(self, model, version, input_tokens):
+        """Досчитанные позже (count_tokens) входные токены."""
+        row = self._rows.get((model, version))
+        if row is not None:
+            row[1] += input_tokens or 0
+
+    def cache_hit(self, model, version):
+        """Ответ для этой модели и версии промпта взят из кэша."""
+        self._hits[(model, version)] = self._hits.get((model, version), 0) + 1
+
+    def stats(self):
+        result = {}
+        for key in sorted(self._rows.keys() | self._hits.keys()):
+            calls, tokens_in, tokens_out, seconds = self._rows.get(key, (0, 0, 0, 0.0))
+            row = {"calls": calls, "cache_hits": self._hits.get(key, 0)}
+            if calls:
+                row.update(
+                    input_avg=round(tokens_in / calls, 1),
+                    output_avg=round(tokens_out / calls, 1),
+                    latency_avg_ms=round(seconds / calls * 1000, 1),
+                )
+            result["|".join(key)] = row
+        return result
+
+    def log(self):
+        if self._rows or self._hits:
+            logging.info(f"🔢 Токены Gemini: {self.stats()}")
+
+
+token_meter = TokenMeter()
+atexit.register(token_meter.log)
+
+
+_token_count_tasks = set()  # ссылки на фоновые count_tokens — иначе задачу может собрать GC до завершения
+
+
+async def _count_input_tokens(gen_model, model, version, contents):
+    try:
+        counted = await gen_model.count_tokens_async(contents)
+        token_meter.add_input(model, version, counted.total_tokens)
+    except Exception as e:
+        logging.debug(f"count_tokens не сработал: {e}")
+
+
+async def gemini_generate(model, contents, premium=False, on_queued=None, config=None, prompt=None, on_slot=None):
+    """
+    Единая точка вызова Gemini: через очередь с ограничением параллельности, с таймаутом модели.
+    on_slot() вызывается, когда запрос дождался слота и уходит в модель.
+    """
+    timeout = GEMINI_TIMEOUT.get(model, GEMINI_TIMEOUT_DEFAULT)
+    options = {"timeout": timeout}
+    # ожидание слота — внутри try: пробный запрос предохранителя, отменённый ещё в очереди,
+    # должен снять отметку о пробе, иначе allow() больше никогда не пропустит модель
+    try:
+        async with inference.slot(model, premium, on_queued):
+            if on_slot is not None:
+                on_slot()
+            gen_model = get_gemini_model(model)
+            started = time.perf_counter()
+            if GEMINI_ASYNC:
+                call = gen_model.generate_content_async(contents, generation_config=config, request_options=options)
+            else:
+                call = asyncio.to_thread(
+                    gen_model.generate_content, contents, generation_config=config, request_options=options
+                )
+            response = await asyncio.wait_for(call, timeout)
+            seconds = time.perf_counter() - started
+    except asyncio.CancelledError:
+        breaker.cancelled(model)
+        raise
+    except Exception:
+        breaker.failure(model)
+        raise
+    breaker.success(model)
+    latencies.add(model, seconds)
+
+    version = prompt.version if prompt is not None else "-"
+    usage = getattr(response, "usage_metadata", None)
+    input_tokens = getattr(usage, "prompt_token_count", 0) if usage else 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) if usage else 0
+    token_meter.record(model, version, input_tokens, output_tokens, seconds)
+    if not input_tokens and GEMINI_COUNT_TOKENS and GEMINI_ASYNC:
+        # старый SDK без usage_metadata — считаем вход отдельным запросом, не задерживая ответ
+        task = asyncio.create_task(_count_input_tokens(gen_model, model, version, contents))
+        _token_count_tasks.add(task)
+        task.add_done_callback(_token_count_tasks.discard)
+    return response
+
+
+def response_text(response):
+    """Текст ответа Gemini (разные версии SDK отдают его по-разному)."""
+    try:
+        if response.text:
+            return response.text.strip()
+    except Exception:
+        pass  # .text бросает, если ответ заблокирован или пуст
+    try:
+        return response.candidates[0].content.parts[0].text.strip()
+    except Exception:
+        return str(response).strip()
+
+
+async def gemini_text(model, contents, premium=False, on_queued=None, config=None, prompt=None, on_slot=None):
+    return response_text(await gemini_generate(model, contents, premium, on_queued, config, prompt, on_slot))
+
+
+class _LeaderCancelled(Exception):
+    """Ведущий запрос SingleFlight отменён — ожидающие повторяют запрос сами."""
+
+
+class SingleFlight:
+    """Склеивает одинаковые параллельные запросы: выполняется один, остальные ждут его результат."""
+
+    def __init__(self):
+        self._inflight = {}  # key -> future
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.shared += 1
+            try:
+                return await asyncio.shield(fut)
+            except _LeaderCancelled:
+                return await self.do(key, fn)  # отменили ведущего, а не нас — пробуем сами
+
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: f.exception())  # без "exception never retrieved"
+        self._inflight[key] = fut
+        self.leaders += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # не fut.cancel(): ожидающий не отличил бы это от собственной отмены (Task.cancelling() — только с 3.11)
+            fut.set_exception(_LeaderCancelled())
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        return {"calls": self.leaders, "deduplicated": self.shared, "inflight": len(self._inflight)}
+
+
+gemini_flight = SingleFlight()
+
+
+# ======================================
+# 🧾 Разбор ответов Gemini
+# ======================================
+
+_NUMBER = {"type": "NUMBER"}
+
+NUTRIENTS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"cal": _NUMBER, "protein": _NUMBER, "fat": _NUMBER, "carbs": _NUMBER},
+    "required": ["cal", "protein", "fat", "carbs"],
+}
+
+MEAL_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "items": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"name": {"type": "STRING"}, "weight_g": _NUMBER, **NUTRIENTS_SCHEMA["properties"]},
+                "required": ["name", "weight_g", "cal", "protein", "fat", "carbs"],
+            },
+        },
+        "total": NUTRIENTS_SCHEMA,
+    },
+    "required": ["items", "total"],
+}
+
+_json_configs = {}
+
+
+def json_config(schema):
+    """
+    GenerationConfig с ответом строго в JSON (и по схеме, если SDK это умеет).
+    Старые версии google-generativeai таких полей не знают — тогда None и обычный текстовый ответ.
+    """
+    key = id(schema)
+    if key not in _json_configs:
+        fields = getattr(genai.GenerationConfig, "__dataclass_fields__", {})
+        config = None
+        if "response_mime_type" in fields:
+            kwargs = {"response_mime_type": "application/json"}
+            if "response_schema" in fields:
+                kwargs["response_schema"] = schema
+            try:
+                config = genai.GenerationConfig(**kwargs)
+            except Exception:
+                logging.exception("GenerationConfig без JSON-режима")
+        _json_configs[key] = config
+    return _json_configs[key]
+
+
+class ResponseDecoder:
+    """
+    Разбирает ответ модели за один проход: JSON читается прямо с первой «{» через raw_decode,
+    без чистки ```json и регулярок. Старые ответы с пояснениями вокруг JSON тоже разбираются —
+    перебором следующих «{». Результат проверяется и превращается в Meal / словарь КБЖУ.
+    """
+
+    MAX_ATTEMPTS = 5  # сколько «{» пробуем, прежде чем сдаться
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self.decoded = 0
+        self.fallback = 0  # JSON нашёлся не с первой «{» — ответ старого формата
+        self.failed = 0
+        self.seconds = 0.0
+
+    def _object(self, text):
+        start = text.find("{") if isinstance(text, str) else -1
+        for attempt in range(self.MAX_ATTEMPTS):
+            if start < 0:
+                break
+            try:
+                obj, _ = self._decoder.raw_decode(text, start)
+            except ValueError:
+                obj = None
+            if isinstance(obj, dict):
+                if attempt:
+                    self.fallback += 1
+                return obj
+            start = text.find("{", start + 1)
+        return None
+
+    def _finish(self, started, result, text, record=True):
+        if not record:
+            return result
+        self.seconds += time.perf_counter() - started
+        if result is None:
+            self.failed += 1
+            logging.warning(f"⚠️ Не удалось разобрать ответ Gemini: {str(text)[:300]!r}")
+        else:
+            self.decoded += 1
+        return result
+
+    def meal(self, text, record=True):
+        """Блюдо из ответа {"items": [...], "total": {...}} или None, если ингредиентов нет."""
+        started = time.perf_counter()
+        data = self._object(text)
+        meal = Meal.from_dict(data) if data is not None else None
+        if meal is not None and not meal.items:
+            meal = None
+        return self._finish(started, meal, text, record)
+
+    def nutrients(self, text, record=True):
+        """{"cal", "protein", "fat", "carbs"} из ответа или None."""
+        started = time.perf_counter()
+        data = self._object(text)
+        result = None
+        if data is not None and any(k in data for k in ("cal", "protein", "fat", "carbs")):
+            result = {k: _num(data.get(k)) for k in ("cal", "protein", "fat", "carbs")}
+        return self._finish(started, result, text, record)
+
+    def stats(self):
+        total = self.decoded + self.failed
+        return {
+            "decoded": self.decoded,
+            "fallback": self.fallback,
+            "failed": self.failed,
+            "avg_ms": round(self.seconds / total * 1000, 3) if total else 0.0,
+        }
+
+
+gemini_decoder = ResponseDecoder()
+
+
+# ======================================
+# 🛡️ Устойчивость вызовов Gemini
+# ======================================
+
+GEMINI_HEDGE_MODEL = os.getenv("GEMINI_HEDGE_MODEL", "gemini-2.5-flash-lite")  # пусто — без подстраховки
+GEMINI_HEDGE_DELAY = float(os.getenv("GEMINI_HEDGE_DELAY", "8"))      # задержка, пока мало замеров
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "2"))
+GEMINI_LATENCY_WINDOW = int(os.getenv("GEMINI_LATENCY_WINDOW", "200"))
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))   # ошибок подряд до размыкания
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+
+class LatencyWindow:
+    """Последние времена ответа по модели — из них p95 для задержки подстраховочного запроса."""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, size=GEMINI_LATENCY_WINDOW):
+        self.size = size
+        self._samples = {}
+
+    def add(self, model, seconds):
+        self._samples.setdefault(model, deque(maxlen=self.size)).append(seconds)
+
+    def p95(self, model):
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def hedge_delay(self, model):
+        p95 = self.p95(model)
+        delay = GEMINI_HEDGE_DELAY if p95 is None else max(GEMINI_HEDGE_MIN_DELAY, p95)
+        return min(delay, GEMINI_TIMEOUT.get(model, GEMINI_TIMEOUT_DEFAULT))
+
+
+class CircuitBreaker:
+    """
+    Предохранитель на модель: после GEMINI_BREAKER_FAILURES ошибок подряд модель на время
+    cooldown считается недоступной, затем пропускается один пробный запрос.
+    """
+
+    def __init__(self, failures=GEMINI_BREAKER_FAILURES, cooldown=GEMINI_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._state = {}  # model -> [ошибок подряд, время размыкания или None, идёт ли пробный запрос]
+        self.trips = 0
+
+    def allow(self, model):
+        state = self._state.get(model)
+        if state is None or state[1] is None:
+            return True
+        if time.monotonic() - state[1] < self.cooldown or state[2]:
+            return False
+        state[2] = True
+        return True
+
+    def success(self, model):
+        state = self._state.get(model)
+        if state is not None and state[1] is not None:
+            logging.info(f"🛡️ {model} снова отвечает")
+        self._state[model] = [0, None, False]
+
+    def failure(self, model):
+        state = self._state.setdefault(model, [0, None, False])
+        state[0] += 1
+        if state[2] or (state[1] is None and state[0] >= self.failures):
+            if not state[2]:
+                self.trips += 1
+                logging.warning(f"🛡️ {model}: {state[0]} ошибок подряд, временно отключаем")
+            state[1] = time.monotonic()
+            state[2] = False
+
+    def cancelled(self, model):
+        """Пробный запрос отменили (проиграл гонку) — следующий может попробовать снова."""
+        state = self._state.get(model)
+        if state is not None:
+            state[2] = False
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "trips": self.trips,
+            "open": [m for m, (_, opened, _) in self._state.items() if opened is not None and now - opened < self.cooldown],
+        }
+
+
+latencies = LatencyWindow()
+breaker = CircuitBreaker()
+hedge_stats = {"hedged": 0, "hedge_won": 0, "failover": 0}
+
+
+async def gemini_resilient(model, build, decode, premium=False, on_queued=None, config=None):
+    """
+    Запрос к Gemini с подстраховкой.
+    build(model) -> (contents, prompt); decode(text, record=False) — проверка, что ответ разбирается.
+    Если основная модель не ответила за p95 её задержки (отсчёт — с момента, когда запрос получил
+    слот в очереди) или упала, параллельно запускается GEMINI_HEDGE_MODEL; берётся первый
+    разборчивый ответ, второй запрос отменяется. Модели с разомкнутым предохранителем пропускаются.
+    Возвращает (текст, модель, которая ответила) — кэшировать ответ нужно под ключом этой модели.
+    """
+    backup = GEMINI_HEDGE_MODEL if GEMINI_HEDGE_MODEL and GEMINI_HEDGE_MODEL != model else None
+    if not breaker.allow(model):
+        if backup is None or not breaker.allow(backup):
+            raise RuntimeError(f"Gemini {model} временно недоступен")
+        logging.info(f"🛡️ {model} отключён, запрос идёт в {backup}")
+        model, backup = backup, None
+
+    async def attempt(m, notice, on_slot=None):
+        contents, prompt = build(m)
+        text = await gemini_text(m, contents, premium, notice, config, prompt, on_slot)
+        if decode(text, record=False) is None:
+            raise ValueError(f"{m}: неразборчивый ответ")
+        return text
+
+    started = asyncio.Event()
+    tasks = {asyncio.create_task(attempt(model, on_queued, started.set)): model}
+    error = None
+    try:
+        while tasks:
+            timeout = None
+            if backup:
+                if not started.is_set():
+                    # ожидание в очереди планировщика не считается медленным ответом модели
+                    slot_wait = asyncio.create_task(started.wait())
+                    await asyncio.wait({slot_wait, *tasks}, return_when=asyncio.FIRST_COMPLETED)
+                    slot_wait.cancel()
+                timeout = latencies.hedge_delay(model)
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                winner = tasks.pop(task)
+                if task.exception() is None:
+                    if winner != model:
+                        hedge_stats["hedge_won"] += 1
+                    return task.result(), winner
+                error = task.exception()
+                logging.warning(f"⚠️ Ошибка Gemini {winner}: {error}")
+            if backup and breaker.allow(backup):
+                hedge_stats["failover" if error is not None else "hedged"] += 1
+                tasks[asyncio.create_task(attempt(backup, None))] = backup
+            backup = None
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 # ======================================
 # 📋 Главное меню и команды
 # ======================================
@@ -257,8 +2395,8 @@ def main_menu():
 @dp.message(Command("start"))
 @dp.message(F.text == "👋 Главное меню")
 async def start_cmd(message: types.Message):
-    user = get_user(message.from_user.id)
-    is_premium = is_premium_active(message.from_user.id)
+    user = await get_user(message.from_user.id)
+    is_premium = premium_active(user)
 
     greeting = (
         f"👋 Привет, {message.from_user.first_name or 'друг'}!\n\n"
@@ -278,7 +2416,7 @@ async def start_cmd(message: types.Message):
 @dp.message(Command("stats"))
 @dp.message(F.text == "📊 Статистика")
 async def stats_cmd(message: types.Message):
-    kcal, p, f, c = get_stats(message.from_user.id)
+    kcal, p, f, c = await get_stats(message.from_user.id)
     if kcal and kcal > 0:
         text = (
             f"📈 *Сегодняшний результат:*\n"
@@ -288,45 +2426,116 @@ async def stats_cmd(message: types.Message):
             f"🍞 Углеводы: {round(c)} г"
         )
     else:
-        text = "🫙 Сегодня ещё ничего не добавлено."
-    await message.answer(text, parse_mode="Markdown")
+        text = "🫙 Сегодня ещё ничего не добавлено."
+    await message.answer(text, parse_mode="Markdown")
+
+
+# ======================================
+# 🕒 /history — история за неделю
+# ======================================
+
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
+HISTORY_MAX_CHARS = 3800  # лимит Telegram 4096 — с запасом на заголовок
+HISTORY_RANGES = {"7": ("7 дней", 7), "30": ("30 дней", 30), "all": ("всё время", None)}
+
+
+def _history_keyboard(span, first, last, has_newer, has_older):
+    builder = InlineKeyboardBuilder()
+    for key, (label, _) in HISTORY_RANGES.items():
+        builder.button(text=f"• {label}" if key == span else label, callback_data=f"hist:{key}:n:")
+    nav = 0
+    if has_newer:
+        builder.button(text="←", callback_data=f"hist:{span}:p:{first}")
+        nav += 1
+    if has_older:
+        builder.button(text="→", callback_data=f"hist:{span}:n:{last}")
+        nav += 1
+    builder.adjust(len(HISTORY_RANGES), *([nav] if nav else []))
+    return builder.as_markup()
+
+
+async def history_page(user_id, span="7", direction="n", cursor=None):
+    """
+    Страница истории по ключу (date, time, id): «n» — старше курсора, «p» — новее.
+    Каждая страница — один проход по индексу idx_meals_history; готовые страницы кэшируются до save_meal.
+    """
+    key = (date.today().isoformat(), span, direction, cursor)
+    pages = _history_pages.get(user_id)
+    if pages is None:
+        pages = _history_pages[user_id] = {}
+    elif key in pages:
+        _history_pages.move_to_end(user_id)
+        return pages[key]
+
+    label, days = HISTORY_RANGES.get(span, HISTORY_RANGES["7"])
+    since = (date.today() - timedelta(days=days)).isoformat() if days else ""
+    sql = ("SELECT id, date, time, description, calories, protein, fat, carbs "
+           "FROM meals WHERE user_id=? AND date>=?")
+    params = [user_id, since]
+    if cursor:
+        d, t, meal_id = cursor.split("|")
+        sql += " AND (date, time, id) > (?, ?, ?)" if direction == "p" else " AND (date, time, id) < (?, ?, ?)"
+        params += [d, t, int(meal_id)]
+    order = "ASC" if direction == "p" else "DESC"
+    sql += f" ORDER BY date {order}, time {order}, id {order} LIMIT ?"
+    params.append(HISTORY_PAGE_SIZE + 1)
+
+    rows = await db.fetchall(sql, params)
+    more = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
+    if direction == "p":
+        rows.reverse()
+    has_newer = more if direction == "p" else bool(cursor)
+    has_older = more if direction == "n" else True
+
+    if not rows:
+        page = (f"📭 История пуста за {label}.", _history_keyboard(span, "", "", False, False))
+    else:
+        # длинные описания режем, чтобы страница целиком влезла в одно сообщение
+        desc_limit = max(60, HISTORY_MAX_CHARS // HISTORY_PAGE_SIZE - 80)
+        text = f"🕒 *История за {label}:*\n\n"
+        for meal_id, d, t, desc, kcal, p, f, c in rows:
+            ingredients = desc.replace("Фото еды", "📷 Фото блюда")
+            if len(ingredients) > desc_limit:
+                ingredients = ingredients[:desc_limit - 1] + "…"
+            text += (
+                f"📅 {d} 🕐 {t}\n"
+                f"🍽️ {ingredients}\n"
+                f"🔥 {round(kcal)} ккал — "
+                f"Б: {round(p)} Ж: {round(f)} У: {round(c)}\n\n"
+            )
+        first, last = rows[0], rows[-1]
+        page = (text.strip(), _history_keyboard(
+            span, f"{first[1]}|{first[2]}|{first[0]}", f"{last[1]}|{last[2]}|{last[0]}", has_newer, has_older
+        ))
 
+    # пока читали, save_meal сбросил страницы (или их вытеснили) — такую страницу не кэшируем
+    if _history_pages.get(user_id) is pages:
+        pages[key] = page
+        _history_pages.move_to_end(user_id)
+    while len(_history_pages) > HISTORY_CACHE_USERS:
+        _history_pages.popitem(last=False)
+    return page
 
-# ======================================
-# 🕒 /history — история за неделю
-# ======================================
 
 @dp.message(Command("history"))
 @dp.message(F.text == "🕒 История")
 async def history_cmd(message: types.Message):
-    """Показать историю за последние 7 дней с временем и ингредиентами."""
-    cursor.execute(
-        "SELECT date, time, description, calories, protein, fat, carbs "
-        "FROM meals WHERE user_id=? AND date>=? "
-        "ORDER BY date DESC, time DESC",
-        (message.from_user.id, (date.today() - timedelta(days=7)).isoformat())
-    )
-    rows = cursor.fetchall()
-
-    if not rows:
-        await message.answer("📭 История пуста за последние 7 дней.")
-        return
-
-    text = "🕒 *История за 7 дней:*\n\n"
-    for d, t, desc, kcal, p, f, c in rows:
-        date_part = f"📅 {d}"
-        #time_part = f"🕐 {t}" if t else ""
-        ingredients = desc.replace("Фото еды", "📷 Фото блюда")
+    """Показать историю за последние 7 дней постранично, с выбором периода."""
+    text, markup = await history_page(message.from_user.id)
+    await message.answer(text, parse_mode="Markdown", reply_markup=markup)
 
-        text += (
-            #{time_part} to show time
-            f"{date_part}\n"
-            f"🍽️ {ingredients}\n"
-            f"🔥 {round(kcal)} ккал — "
-            f"Б: {round(p)} Ж: {round(f)} У: {round(c)}\n\n"
-        )
 
-    await message.answer(text.strip(), parse_mode="Markdown")
+@dp.callback_query(F.data.startswith("hist:"))
+async def history_nav(callback: types.CallbackQuery):
+    """Листание /history и смена периода."""
+    _, span, direction, cursor = callback.data.split(":", 3)
+    text, markup = await history_page(callback.from_user.id, span, direction, cursor or None)
+    try:
+        await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=markup)
+    except TelegramBadRequest:
+        pass  # «message is not modified» — нажали на уже открытый период
+    await callback.answer()
 
 # ======================================
 # ℹ️ /help — справка
@@ -344,7 +2553,9 @@ async def help_cmd(message: types.Message):
         "/start — главное меню\n"
         "/stats — статистика за день\n"
         "/history — история за неделю\n"
+        "/week, /month — отчёт за неделю и месяц 💎\n"
         "/premium — Premium-возможности\n"
+        "/timezone — часовой пояс для отчётов\n"
         "/help — справка"
     )
     await message.answer(text, parse_mode="Markdown", reply_markup=main_menu())
@@ -356,8 +2567,7 @@ async def help_cmd(message: types.Message):
 @dp.message(F.text == "✍️ Ввести вручную")
 async def manual_input(message: types.Message):
     """Начинает ручной ввод блюда."""
-    user_id = str(message.from_user.id)
-    dp.workflow_data[user_id] = {"mode": "manual_input"}
+    await workflows.save(message.from_user.id, Workflow(mode="manual_input"))
 
     await message.answer(
         "📝 Введи блюдо текстом, например:\n\n"
@@ -387,8 +2597,7 @@ async def feedback_entry(message: types.Message):
 
 @dp.callback_query(F.data.in_(["feedback", "cooperation"]))
 async def feedback_choose(callback: types.CallbackQuery):
-    user_key = str(callback.from_user.id)
-    dp.workflow_data[user_key] = {"mode": callback.data}
+    await workflows.save(callback.from_user.id, Workflow(mode=callback.data))
     await callback.message.answer("✍️ Напиши сообщение, я передам его напрямую разработчику 👇")
     await callback.answer()
 
@@ -435,7 +2644,7 @@ async def premium_features(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "check_premium")
 async def check_premium(callback: types.CallbackQuery):
-    if is_premium_active(callback.from_user.id):
+    if await is_premium_active(callback.from_user.id):
         await callback.message.answer("✅ Premium активен! Наслаждайтесь полным функционалом 💪")
     else:
         await callback.message.answer("⚠️ Premium не активирован. Нажми /premium, чтобы оформить 💎")
@@ -490,24 +2699,55 @@ async def buy_premium(callback: types.CallbackQuery):
 
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))  # параллельных соединений к api.telegram.org
+HTTP_KEEPALIVE = int(os.getenv("HTTP_KEEPALIVE", "60"))            # сколько держать простаивающее соединение, сек
+
+_http_session = None
+
+
+def get_http_session():
+    """Общая на всё приложение aiohttp-сессия: keep-alive, кэш DNS, один TLS-контекст."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            ssl=ssl_context,
+            limit=100,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=HTTP_KEEPALIVE,
+        )
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    """Экспоненциальная задержка с jitter: попытки разных фото не совпадают по времени."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
 async def safe_download(bot, file_path, retries=3, timeout=30):
     """Безопасно загружает файл с Telegram CDN с несколькими попытками."""
     file_url = f"https://api.telegram.org/file/bot{bot.token}/{file_path}"
+    session = get_http_session()
 
     for attempt in range(retries):
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
-                async with session.get(file_url, ssl=ssl_context) as resp:
-                    if resp.status == 200:
-                        return await resp.read()
-                    else:
-                        logging.warning(f"⚠️ Ошибка {resp.status} при загрузке файла с Telegram CDN.")
+            async with session.get(file_url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                if resp.status == 200:
+                    return await resp.read()
+                logging.warning(f"⚠️ Ошибка {resp.status} при загрузке файла с Telegram CDN.")
+                if attempt == retries - 1:
+                    raise RuntimeError(f"Telegram CDN вернул {resp.status}")
         except (aiohttp.ClientError, asyncio.TimeoutError, ssl.SSLError) as e:
-            if attempt < retries - 1:
-                logging.warning(f"⏳ Попытка {attempt+2}/{retries} после ошибки: {e}")
-                await asyncio.sleep(2)
-            else:
+            if attempt == retries - 1:
                 raise
+            logging.warning(f"⏳ Попытка {attempt+2}/{retries} после ошибки: {e}")
+        await asyncio.sleep(backoff_delay(attempt))
 
 # =================== Stripe helpers ===================
 
@@ -609,7 +2849,8 @@ async def stripe_webhook(request: web.Request):
                     until = datetime.fromtimestamp(int(period_end_ts))
 
                     # если уже есть более дальняя дата — не укорачиваем
-                    old = get_user(int(user_id))[4]
+                    invalidate_user(int(user_id))
+                    old = (await get_user(int(user_id)))[4]
                     if old:
                         try:
                             old_dt = datetime.fromisoformat(old)
@@ -618,7 +2859,7 @@ async def stripe_webhook(request: web.Request):
                         except Exception:
                             pass
 
-                    update_user(int(user_id), is_premium=1, premium_until=until.isoformat())
+                    await set_premium(int(user_id), 1, until.isoformat())
                     logging.info(f"Activated premium for user {user_id} until {until}")
 
         # 2) Продление подписки (каждый успешный платеж)
@@ -639,7 +2880,8 @@ async def stripe_webhook(request: web.Request):
                 if user_id and period_end_ts:
                     until = datetime.fromtimestamp(int(period_end_ts))
 
-                    old = get_user(int(user_id))[4]
+                    invalidate_user(int(user_id))
+                    old = (await get_user(int(user_id)))[4]
                     if old:
                         try:
                             old_dt = datetime.fromisoformat(old)
@@ -648,7 +2890,7 @@ async def stripe_webhook(request: web.Request):
                         except Exception:
                             pass
 
-                    update_user(int(user_id), is_premium=1, premium_until=until.isoformat())
+                    await set_premium(int(user_id), 1, until.isoformat())
                     logging.info(f"Renewed premium for user {user_id} until {until}")
 
         # 3) Отмена / изменение подписки
@@ -666,13 +2908,13 @@ async def stripe_webhook(request: web.Request):
 
             # отменили сразу (без «действует до конца периода»)
             if status == "canceled" and not cancel_at_period_end:
-                update_user(int(user_id), is_premium=0, premium_until=None)
+                await set_premium(int(user_id), 0, None)
                 logging.info(f"Premium revoked immediately for user {user_id}")
             else:
                 # отмена в конце периода — держим до current_period_end
                 if period_end_ts:
                     until = datetime.fromtimestamp(int(period_end_ts)).isoformat()
-                    update_user(int(user_id), is_premium=1, premium_until=until)
+                    await set_premium(int(user_id), 1, until)
                     logging.info(f"Premium for user {user_id} active until period end {until}")
 
     except Exception:
@@ -682,23 +2924,32 @@ async def stripe_webhook(request: web.Request):
     return web.Response(status=200)
 
 
-async def start_stripe_webserver(host="0.0.0.0", port=8080):
-    """Запускает aiohttp webserver с endpoint /stripe/webhook + страницы успеха/отмены."""
+def build_web_app(webhook=None):
+    """aiohttp-приложение: /stripe/webhook, страницы успеха/отмены и (в режиме webhook) вход Telegram."""
     app = web.Application()
 
     # Stripe webhook
     app.router.add_post("/stripe/webhook", stripe_webhook)
 
+    # Telegram webhook — на том же приложении и порту, что и Stripe
+    if webhook is not None:
+        app.router.add_post(WEBHOOK_PATH, webhook.handle)
+
     # Страницы после оплаты
     app.router.add_get("/success", success_page)
     app.router.add_get("/cancel", cancel_page)
     app.router.add_get("/", root_page)
+    return app
+
 
+async def start_webserver(app, host=WEB_HOST, port=WEB_PORT):
+    """Запускает aiohttp webserver; возвращает runner, чтобы остановить его при выходе."""
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, host, port)
     await site.start()
-    logging.info(f"Stripe webserver running on {host}:{port}")
+    logging.info(f"Webserver running on {host}:{port}")
+    return runner
 
 
     # --- Страницы после оплаты ---
@@ -763,29 +3014,117 @@ async def root_page(request: web.Request):
     """
     return web.Response(text=html, content_type="text/html")
 
+# ======================================
+# 🪝 Telegram webhook
+# ======================================
+
+class WebhookWorkers:
+    """
+    Приём апдейтов по webhook: проверка секретного заголовка, быстрый ответ 200
+    и обработка в ограниченном пуле воркеров через очередь фиксированного размера.
+    """
+
+    def __init__(self, secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE):
+        self.secret = secret
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize)
+        self._tasks = []
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+
+    async def handle(self, request: web.Request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            self.rejected += 1
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.dropped += 1  # Telegram повторит доставку — возможно, на другую реплику
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await dp.feed_update(bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logging.exception("Ошибка обработки апдейта")
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        """Доработать то, что уже в очереди, и остановить воркеры."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"🪝 Не дождались {self._queue.qsize()} апдейтов при остановке")
+        for task in self._tasks:
+            task.cancel()
+
+    def stats(self):
+        return {"received": self.received, "rejected": self.rejected, "dropped": self.dropped,
+                "processed": self.processed, "failed": self.failed, "queued": self._queue.qsize()}
+
+
+async def run_webhook(webhook):
+    """Регистрирует webhook в Telegram и ждёт; False — не получилось, нужен polling."""
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    except Exception:
+        logging.exception("Не удалось установить webhook — переходим на polling")
+        return False
+    webhook.start()
+    logging.info(f"🪝 Webhook: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await webhook.stop()
+        logging.info(f"🪝 Webhook: {webhook.stats()}")
+
+
 # ======================================
 # 💬 Универсальный обработчик текста (ввод блюда, редактирование, отзывы)
 # ======================================
 
 @dp.message(F.text & ~F.text.startswith("/"))
 async def handle_any_text(message: types.Message):
-    user_key = str(message.from_user.id)
+    user_id = message.from_user.id
 
     # ----- Admin secret premium -----
     secret = os.getenv("ADMIN_PREMIUM_CODE", "")
     if secret and message.text.strip() == secret:
         until = (datetime.now() + timedelta(days=30)).isoformat()
-        update_user(message.from_user.id, is_premium=1, premium_until=until)
+        await set_premium(message.from_user.id, 1, until)
         await message.answer("✅ Админ-Premium активирован на 30 дней.")
         return
     # --------------------------------
 
-    wf = dp.workflow_data.get(user_key)
+    wf = await workflows.get(user_id)
 
     # Если пользователь сейчас пишет отзыв / сотрудничество
-    if wf and wf.get("mode") in ["feedback", "cooperation"]:
+    if wf and wf.mode in ["feedback", "cooperation"]:
         try:
-            mode = "📝 Отзыв" if wf["mode"] == "feedback" else "🤝 Сотрудничество"
+            mode = "📝 Отзыв" if wf.mode == "feedback" else "🤝 Сотрудничество"
             await bot.send_message(
                 FEEDBACK_TARGET_ID,
                 f"{mode} от @{message.from_user.username or message.from_user.id}:\n\n{message.text}"
@@ -796,113 +3135,94 @@ async def handle_any_text(message: types.Message):
             logging.error(f"Ошибка при отправке отзыва: {e}")
             await message.answer("⚠️ Не удалось отправить сообщение. Попробуй позже.")
         finally:
-            dp.workflow_data.pop(user_key, None)
+            await workflows.pop(user_id)
         return
 
         # --- изменение названия ингредиента с пересчётом ---
-    if wf.get("stage") == "await_name":
+    if wf and wf.stage == "await_name":
         new_name = message.text.strip()
-        idx = wf.get("editing_index")
+        idx = wf.editing_index
 
-        if idx is None or idx >= len(wf["meal"]["items"]):
+        if idx is None or wf.meal is None or idx >= len(wf.meal.items):
             await message.answer("⚠️ Ошибка: ингредиент не найден.")
-            wf["stage"] = None
+            wf.stage = None
+            await workflows.save(user_id, wf)
             return
+        item = wf.meal.items[idx]
 
         await message.answer(f"🔄 Пересчитываю КБЖУ для *{new_name}*...", parse_mode="Markdown")
 
         try:
-            # ✨ Пересчитываем только один ингредиент с помощью Gemini
-            model = "gemini-2.5-flash" if is_premium_active(message.from_user.id) else "gemini-2.5-flash-lite"
-            gen_model = genai.GenerativeModel(model)
-
-            prompt = f"""
-            Ты — эксперт по питанию. Определи КБЖУ для продукта "{new_name}" в количестве {wf["meal"]["items"][idx]["weight_g"]} г.
-            Ответ строго в JSON формате:
-            {{
-              "cal": число,
-              "protein": число,
-              "fat": число,
-              "carbs": число
-            }}
-            """
-
-            response = await asyncio.to_thread(gen_model.generate_content, [prompt])
-
-            # ✅ Безопасно извлекаем результат из Gemini
-            if hasattr(response, "text") and response.text:
-                result = response.text.strip()
-            elif hasattr(response, "candidates"):
-                try:
-                    result = response.candidates[0].content.parts[0].text.strip()
-                except Exception:
-                    result = ""
-            else:
-                result = str(response).strip()
-
-            cleaned = result.replace("```json", "").replace("```", "").strip()
-            match = re.search(r"\{.*\}", cleaned, re.DOTALL)
-            cleaned = match.group(0) if match else "{}"
-
-            try:
-                data = json.loads(cleaned)
-            except Exception:
-                data = {}
-
-            cal = data.get("cal", 0)
-            p = data.get("protein", 0)
-            f = data.get("fat", 0)
-            c = data.get("carbs", 0)
-
-            wf["meal"]["items"][idx].update({
-                "name": new_name,
-                "cal": cal,
-                "protein": p,
-                "fat": f,
-                "carbs": c
-            })
+            # 🥗 Частые продукты считаем по локальной таблице — без запроса к Gemini.
+            # Только точное название, основа или синоним: похожее по буквам слово
+            # (печень → печенье) даст чужие калории, такое пусть считает Gemini.
+            data = nutrition_index.lookup(new_name, item.weight_g, fuzzy=False)
+
+            if data is None:
+                # ✨ Пересчитываем только один ингредиент с помощью Gemini
+                premium = await is_premium_active(user_id)
+                model = "gemini-2.5-flash" if premium else "gemini-2.5-flash-lite"
+
+                cache_key = make_cache_key(cache_scope("rename", model), f"rename:{new_name}|{item.weight_g}")
+                result = await cache_get(cache_key)
+
+                if result is None:
+                    result, answered = await gemini_flight.do(cache_key, lambda: gemini_resilient(
+                        model, prompt_contents("rename", name=new_name, weight=item.weight_g),
+                        gemini_decoder.nutrients, premium, queue_notice(message), json_config(NUTRIENTS_SCHEMA),
+                    ))
+                    if answered != model:
+                        # ответила подстраховочная модель — кэшируем под её ключом
+                        cache_key = make_cache_key(cache_scope("rename", answered), f"rename:{new_name}|{item.weight_g}")
+
+                data = gemini_decoder.nutrients(result)
+                if data:
+                    await cache_set(cache_key, json.dumps(data, ensure_ascii=False))
+                else:
+                    data = {}
+
+            item.name = new_name
+            item.cal = _num(data.get("cal"))
+            item.protein = _num(data.get("protein"))
+            item.fat = _num(data.get("fat"))
+            item.carbs = _num(data.get("carbs"))
 
             # 🔄 Пересчёт общего КБЖУ
-            total = {"cal": 0, "protein": 0, "fat": 0, "carbs": 0}
-            for i in wf["meal"]["items"]:
-                total["cal"] += i.get("cal", 0)
-                total["protein"] += i.get("protein", 0)
-                total["fat"] += i.get("fat", 0)
-                total["carbs"] += i.get("carbs", 0)
-            wf["meal"]["total"] = {k: round(v, 2) for k, v in total.items()}
-
-            wf["stage"] = None
+            meal = wf.meal
+            meal.recalc()
+            wf.stage = None
 
             await message.answer(
                 f"✅ Название обновлено, КБЖУ пересчитано!\n\n"
-                f"🔥 *Итого:* {round(total['cal'])} ккал\n"
-                f"Б: {round(total['protein'])} г  Ж: {round(total['fat'])} г  У: {round(total['carbs'])} г",
+                f"🔥 *Итого:* {round(meal.cal)} ккал\n"
+                f"Б: {round(meal.protein)} г  Ж: {round(meal.fat)} г  У: {round(meal.carbs)} г",
                 parse_mode="Markdown"
             )
-            await show_updated_meal(message.from_user.id)
+            await show_updated_meal(user_id, wf)
 
         except Exception as e:
             logging.error(f"Ошибка пересчёта КБЖУ для нового ингредиента: {e}")
             await message.answer("⚠️ Не удалось пересчитать КБЖУ. Название обновлено, но значения остались прежними.")
-            wf["meal"]["items"][idx]["name"] = new_name
-            wf["stage"] = None
-            await show_updated_meal(message.from_user.id)
+            item.name = new_name
+            wf.stage = None
+            await show_updated_meal(user_id, wf)
         return
 
 
     # --- изменение веса ---
-    if wf.get("stage") == "await_weight":
+    if wf and wf.stage == "await_weight":
         try:
             new_weight = float(message.text.strip())
-            idx = wf.get("editing_index")
+            idx = wf.editing_index
 
-            if idx is None or idx >= len(wf["meal"]["items"]):
+            if idx is None or wf.meal is None or idx >= len(wf.meal.items):
                 await message.answer("⚠️ Ошибка: ингредиент не найден.")
-                wf["stage"] = None
+                wf.stage = None
+                await workflows.save(user_id, wf)
                 return
 
-            item = wf["meal"]["items"][idx]
-            old_weight = item.get("weight_g", 1)
+            item = wf.meal.items[idx]
+            old_weight = item.weight_g or 1
 
             if new_weight <= 0:
                 await message.answer("⚠️ Вес должен быть положительным числом.")
@@ -910,114 +3230,71 @@ async def handle_any_text(message: types.Message):
 
             # 🔥 Пересчёт пропорционально новому весу
             factor = new_weight / old_weight
-            for key in ["cal", "protein", "fat", "carbs"]:
-                item[key] = round(item.get(key, 0) * factor, 2)
-            item["weight_g"] = new_weight
+            item.cal = round(item.cal * factor, 2)
+            item.protein = round(item.protein * factor, 2)
+            item.fat = round(item.fat * factor, 2)
+            item.carbs = round(item.carbs * factor, 2)
+            item.weight_g = _num(new_weight)
 
             # 🔄 Пересчёт общего КБЖУ
-            total = {"cal": 0, "protein": 0, "fat": 0, "carbs": 0}
-            for i in wf["meal"]["items"]:
-                total["cal"] += i.get("cal", 0)
-                total["protein"] += i.get("protein", 0)
-                total["fat"] += i.get("fat", 0)
-                total["carbs"] += i.get("carbs", 0)
-            # 🔢 Округляем значения для стабильного отображения
-            total = {k: round(v, 2) for k, v in total.items()}
-            wf["meal"]["total"] = total
-
-            wf["stage"] = None
+            meal = wf.meal
+            meal.recalc()
+            wf.stage = None
 
             # ✅ Показываем обновлённое блюдо
             await message.answer(
                 f"✅ Вес обновлён и КБЖУ пересчитано!\n\n"
-                f"🔥 *Итого:* {round(total['cal'])} ккал\n"
-                f"Б: {round(total['protein'])} г  Ж: {round(total['fat'])} г  У: {round(total['carbs'])} г",
+                f"🔥 *Итого:* {round(meal.cal)} ккал\n"
+                f"Б: {round(meal.protein)} г  Ж: {round(meal.fat)} г  У: {round(meal.carbs)} г",
                 parse_mode="Markdown"
             )
-            await show_updated_meal(message.from_user.id)
+            await show_updated_meal(user_id, wf)
 
         except ValueError:
             await message.answer("⚠️ Введите корректное число (в граммах).")
         return
     
         # Если идёт ручной ввод блюда
-    if wf and wf.get("mode") == "manual_input":
-        dp.workflow_data[user_key]["mode"] = None
+    if wf and wf.mode == "manual_input":
+        wf.mode = None
+        await workflows.save(user_id, wf)
         user_text = message.text.strip()
         await message.answer("🍽️ Анализирую блюдо...")
 
         try:
-            model = "gemini-2.5-flash" if is_premium_active(message.from_user.id) else "gemini-2.5-flash-lite"
-            gen_model = genai.GenerativeModel(model)
-
-            # 🧠 Промпт для Gemini
-            prompt = f"""
-            Ты — эксперт по питанию. Пользователь описал блюдо:
-            "{user_text}"
-
-            Определи ингредиенты, примерный вес и рассчитай КБЖУ.
-            Ответ строго в JSON формате, как в примере:
-
-            {{
-            "items": [
-                {{"name": "курица", "weight_g": 150, "cal": 230, "protein": 32, "fat": 5, "carbs": 0}},
-                {{"name": "рис", "weight_g": 200, "cal": 260, "protein": 6, "fat": 2, "carbs": 56}}
-            ],
-            "total": {{"cal": 490, "protein": 38, "fat": 7, "carbs": 56}}
-            }}
-            """
-
-            # --- Отправляем запрос в Gemini ---
-            response = await asyncio.to_thread(gen_model.generate_content, [prompt])
-
-            # ✅ Универсальный способ извлечь текст из ответа Gemini
-            if hasattr(response, "text") and response.text:
-                result = response.text.strip()
-            elif hasattr(response, "candidates"):
-                try:
-                    result = response.candidates[0].content.parts[0].text.strip()
-                except Exception:
-                    result = ""
-            else:
-                result = str(response).strip()
+            premium = await is_premium_active(message.from_user.id)
+            model = "gemini-2.5-flash" if premium else "gemini-2.5-flash-lite"
 
-            # 🧹 Очистка и попытка вытащить JSON
-            cleaned = result.replace("```json", "").replace("```", "").strip()
+            # 🥗 «овсянка 100г банан 50г» — всё есть в локальной таблице, Gemini не нужен
+            meal = parse_manual_meal(user_text)
 
-            if not cleaned.startswith("{"):
-                match = re.search(r"\{.*\}", cleaned, re.DOTALL)
-                cleaned = match.group(0) if match else "{}"
+            if meal is None:
+                # --- Сначала кэш, затем запрос в Gemini ---
+                cache_key = make_cache_key(cache_scope("manual", model), f"manual:{user_text}")
+                result = await cache_get(cache_key)
 
-            try:
-                data = json.loads(cleaned)
-            except Exception as e:
-                logging.warning(f"⚠️ Ошибка парсинга JSON Gemini: {e}\nОтвет: {result}")
-                data = {"items": [], "total": {}}
+                if result is None:
+                    result, answered = await gemini_flight.do(cache_key, lambda: gemini_resilient(
+                        model, prompt_contents("manual", text=user_text),
+                        gemini_decoder.meal, premium, queue_notice(message), json_config(MEAL_SCHEMA),
+                    ))
+                    if answered != model:
+                        # ответила подстраховочная модель — кэшируем под её ключом
+                        cache_key = make_cache_key(cache_scope("manual", answered), f"manual:{user_text}")
 
-            items, total = data.get("items", []), data.get("total", {})
+                meal = gemini_decoder.meal(result)
 
-            # Если ничего не найдено
-            if not items:
-                await message.answer("⚠️ Не удалось определить блюдо. Попробуй уточнить или переформулировать.")
-                return
+                # Если ничего не найдено
+                if meal is None:
+                    await message.answer("⚠️ Не удалось определить блюдо. Попробуй уточнить или переформулировать.")
+                    return
 
-            kcal = total.get("cal", 0)
-            p, f, c = total.get("protein", 0), total.get("fat", 0), total.get("carbs", 0)
+                await cache_set(cache_key, json.dumps(meal.to_dict(), ensure_ascii=False))
 
-            text = "🍽️ *Анализ блюда:*\n" + "\n".join(
-                [f"- {i['name']} ({i['weight_g']} г)" for i in items]
+            await workflows.save(user_id, Workflow(meal=meal))
+            await message.answer(
+                meal_summary(meal, "🍽️ *Анализ блюда:*"), parse_mode="Markdown", reply_markup=meal_keyboard(premium)
             )
-            text += f"\n\n🔥 *Итого:* {round(kcal)} ккал\nБ: {round(p)} г  Ж: {round(f)} г  У: {round(c)} г"
-
-            builder = InlineKeyboardBuilder()
-            builder.button(text="✏️ Изменить ингредиент", callback_data="edit_meal")
-            builder.button(text="✅ Добавить в статистику", callback_data="save_meal_to_stats")
-            if not is_premium_active(message.from_user.id):
-                builder.button(text="💎 Получить Premium", callback_data="buy_premium")
-            builder.adjust(2)
-
-            dp.workflow_data[user_key] = {"meal": {"items": items, "total": total}}
-            await message.answer(text, parse_mode="Markdown", reply_markup=builder.as_markup())
 
         except Exception as e:
             logging.error(f"Ошибка анализа текста: {e}")
@@ -1032,105 +3309,269 @@ async def handle_any_text(message: types.Message):
 # 🍝 Обработка фото и анализ Gemini
 # ======================================
 
+def meal_summary(meal, title="🍽️ *Обнаружено:*"):
+    text = title + "\n" + "\n".join(f"- {i.name} ({i.weight_g} г)" for i in meal.items)
+    text += f"\n\n🔥 *Итого:* {round(meal.cal)} ккал\nБ: {round(meal.protein)} г  Ж: {round(meal.fat)} г  У: {round(meal.carbs)} г"
+    return text
+
+
+def meal_keyboard(premium):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✏️ Изменить ингредиент", callback_data="edit_meal")
+    builder.button(text="✅ Добавить в статистику", callback_data="save_meal_to_stats")
+    if not premium:
+        builder.button(text="💎 Получить Premium", callback_data="buy_premium")
+    builder.adjust(2)
+    return builder.as_markup()
+
+
 @dp.message(F.photo)
 async def handle_photo(message: types.Message):
     """Обработка фото еды и анализ через Gemini."""
-    ok, reason = can_analyze_photo(message.from_user.id)
+    # 📚 Фото из альбома собираем вместе и анализируем одним запросом
+    if message.media_group_id:
+        albums.add(message)
+        return
+
+    # пользователь и статус Premium определяются один раз на всё сообщение
+    user = await get_user(message.from_user.id)
+    premium = premium_active(user)
+
+    ok, reason = await can_analyze_photo(user, premium)
     if not ok:
         await message.answer(reason, parse_mode="Markdown")
         return
 
     await message.answer("🧠 Анализирую блюдо…")
-    photo = message.photo[-1]
-    file = await bot.get_file(photo.file_id)
+    # самый маленький вариант фото, которого хватает для анализа по тарифу
+    photo = pick_photo_size(message.photo, PHOTO_TARGET_PX[premium])
+    model = "gemini-2.5-flash" if premium else "gemini-2.5-flash-lite"
 
-    # --- безопасная загрузка файла ---
-    try:
-        image_bytes = await safe_download(bot, file.file_path)
-    except Exception as e:
-        logging.error(f"⚠️ Ошибка загрузки файла: {e}")
-        await message.answer("⚠️ Не удалось загрузить фото. Проверь соединение и попробуй снова.")
-        return
+    # ⚡ Это фото (пересланное, репост из группы) уже анализировали — ни скачивания, ни Gemini
+    file_key = f"{cache_scope('photo', model)}:file:{photo.file_unique_id}"
+    result = await cache_get(file_key)
+
+    cache_key = None
+    phash = None
+    if result is None:
+        file = await bot.get_file(photo.file_id)
+
+        # --- безопасная загрузка файла ---
+        try:
+            image_bytes = await safe_download(bot, file.file_path)
+        except Exception as e:
+            logging.error(f"⚠️ Ошибка загрузки файла: {e}")
+            await message.answer("⚠️ Не удалось загрузить фото. Проверь соединение и попробуй снова.")
+            return
 
     # лимит фото
     try:
-        increment_photo(message.from_user.id)
+        await increment_photo(message.from_user.id)
     except Exception:
         logging.exception("Ошибка increment_photo")
 
     try:
-        model = "gemini-2.5-flash" if is_premium_active(message.from_user.id) else "gemini-2.5-flash-lite"
-        gen_model = genai.GenerativeModel(model)
+        if result is None:
+            # 🧠 Одинаковое фото той же моделью уже анализировали — Gemini не вызываем
+            cache_key = make_cache_key(cache_scope("photo", model), image_bytes)
+            result = await cache_get(cache_key)
 
-        response = await asyncio.to_thread(gen_model.generate_content, [ANALYSIS_PROMPT, {"mime_type": "image/jpeg", "data": image_bytes}])
-
-        # ✅ Проверяем разные варианты, как Gemini возвращает ответ
-        if hasattr(response, "text") and response.text:
-            result = response.text.strip()
-        elif hasattr(response, "candidates"):
+        # 🖼️ Похожее фото (другой ракурс, пережатие Telegram) — берём прошлый анализ
+        if result is None and photo_index.enabled:
             try:
-                result = response.candidates[0].content.parts[0].text.strip()
+                phash = await asyncio.to_thread(dhash, image_bytes)
+                result = await photo_index.find(phash, message.from_user.id, cache_scope("photo", model))
+                if result is not None:
+                    token_meter.cache_hit(model, get_prompt("photo", model).version)
             except Exception:
-                result = ""
-        else:
-            result = str(response).strip()
-        if result.startswith("```"):
-            result = result.replace("```json", "").replace("```", "").strip()
-
-        # 🧠 Безопасно обрабатываем ответ Gemini
-        if not result or not isinstance(result, str):
-            await message.answer("⚠️ Gemini не смог распознать фото. Попробуй другое изображение или более чёткое фото.")
+                logging.exception("Ошибка перцептивного хэша")
+            if result is not None:
+                phash = None  # уже в индексе
+
+        if result is None:
+            upload_bytes = await prepare_image(image_bytes, premium, max(photo.width, photo.height))
+
+            # одинаковое фото, пришедшее одновременно (пересылка в группу, двойная отправка) — один запрос
+            result, answered = await gemini_flight.do(cache_key, lambda: gemini_resilient(
+                model,
+                prompt_contents("photo", {"mime_type": "image/jpeg", "data": upload_bytes}),
+                gemini_decoder.meal,
+                premium,
+                queue_notice(message),
+                json_config(MEAL_SCHEMA),
+            ))
+            if answered != model:
+                # ответила подстраховочная модель: её ответ не должен попасть в кэш основной
+                model = answered
+                file_key = f"{cache_scope('photo', model)}:file:{photo.file_unique_id}"
+                cache_key = make_cache_key(cache_scope("photo", model), image_bytes)
+
+        # 🧠 Ответ Gemini (или из кэша) → блюдо; пустой или битый ответ — None
+        meal = gemini_decoder.meal(result)
+        if meal is None:
+            await message.answer("⚠️ Не удалось определить ингредиенты. Попробуй другое фото.")
             return
 
-        # 🧹 Если Gemini вернул Markdown — чистим от ```json
-        cleaned = result.replace("```json", "").replace("```", "").strip()
+        result_json = json.dumps(meal.to_dict(), ensure_ascii=False)
+        await cache_set(file_key, result_json)
+        if cache_key:
+            await cache_set(cache_key, result_json)
+        if phash is not None:
+            await photo_index.add(phash, message.from_user.id, cache_scope("photo", model), result_json)
+
+        await message.answer(meal_summary(meal), parse_mode="Markdown", reply_markup=meal_keyboard(premium))
+
+        await workflows.save(message.from_user.id, Workflow(meal=meal))
 
-        # ⚙️ Если ответ не похож на JSON — пытаемся вытащить JSON из текста
-        if not cleaned.startswith("{"):
-            match = re.search(r"\{.*\}", cleaned, re.DOTALL)
-            cleaned = match.group(0) if match else "{}"
+    except Exception as e:
+        logging.error(f"Ошибка анализа Gemini: {e}")
+        await message.answer("⚠️ Ошибка анализа фото. Попробуй снова.")
+
+
+# ======================================
+# 📚 Альбомы: несколько фото — один анализ
+# ======================================
+
+ALBUM_WINDOW_MS = int(os.getenv("ALBUM_WINDOW_MS", "800"))  # сколько ждать остальные фото альбома
+ALBUM_MAX_PHOTOS = int(os.getenv("ALBUM_MAX_PHOTOS", "10"))
 
+
+class AlbumCollector:
+    """
+    Telegram присылает альбом отдельными сообщениями с общим media_group_id.
+    Копим их, пока новые приходят чаще ALBUM_WINDOW_MS, потом отдаём пачкой в handler.
+    """
+
+    def __init__(self, handler, window_ms=ALBUM_WINDOW_MS):
+        self.handler = handler
+        self.window = window_ms / 1000
+        self._groups = {}  # media_group_id -> [сообщения, время последнего, задача сброса]
+        self.albums = 0
+        self.photos = 0
+
+    def add(self, message):
+        group = self._groups.get(message.media_group_id)
+        if group is None:
+            group = self._groups[message.media_group_id] = [[message], time.monotonic(), None]
+            group[2] = asyncio.create_task(self._flush_later(message.media_group_id))
+        else:
+            group[0].append(message)
+            group[1] = time.monotonic()
+
+    async def _flush_later(self, group_id):
+        while True:
+            left = self._groups[group_id][1] + self.window - time.monotonic()
+            if left <= 0:
+                break
+            await asyncio.sleep(left)
+        messages, *_ = self._groups.pop(group_id)
+        messages.sort(key=lambda m: m.message_id)
+        self.albums += 1
+        self.photos += len(messages)
         try:
-            data = json.loads(cleaned)
-        except Exception as e:
-            logging.error(f"⚠️ Ошибка парсинга JSON Gemini: {e}\nОтвет: {cleaned}")
-            await message.answer("⚠️ Не удалось обработать ответ Gemini. Попробуй другое фото.")
-            return
+            await self.handler(messages[:ALBUM_MAX_PHOTOS])
+        except Exception:
+            logging.exception("Ошибка обработки альбома")
 
-        # ✅ ВОТ ЭТИ 2 СТРОКИ НУЖНО ДОБАВИТЬ
-        items = data.get("items", [])
-        total = data.get("total", {})
+    def stats(self):
+        return {"albums": self.albums, "photos": self.photos, "pending": len(self._groups)}
 
-        if not items:
-            await message.answer("⚠️ Не удалось определить ингредиенты. Попробуй другое фото.")
-            return
 
-        kcal = total.get("cal", 0)
-        p = total.get("protein", 0)
-        f = total.get("fat", 0)
-        c = total.get("carbs", 0)
+async def _download_photo(photo):
+    file = await bot.get_file(photo.file_id)
+    return await safe_download(bot, file.file_path)
 
-        text = "🍽️ *Обнаружено:*\n"
-        for i in items:
-            text += f"- {i.get('name', '—')} ({i.get('weight_g', 0)} г)\n"
-        text += f"\n🔥 *Итого:* {round(kcal)} ккал\nБ: {round(p)} г  Ж: {round(f)} г  У: {round(c)} г"
 
-        builder = InlineKeyboardBuilder()
-        builder.button(text="✏️ Изменить ингредиент", callback_data="edit_meal")
-        builder.button(text="✅ Добавить в статистику", callback_data="save_meal_to_stats")
-        if not is_premium_active(message.from_user.id):
-            builder.button(text="💎 Получить Premium", callback_data="buy_premium")
-        builder.adjust(2)
+async def handle_album(messages):
+    """Альбом фото: параллельная загрузка и один запрос к Gemini со всеми снимками."""
+    message = messages[0]
+    user = await get_user(message.from_user.id)
+    premium = premium_active(user)
+
+    ok, reason = await can_analyze_photo(user, premium)
+    if not ok:
+        await message.answer(reason, parse_mode="Markdown")
+        return
+    # каждое фото альбома — единица дневного лимита: сверх остатка не анализируем
+    left = photos_left(user, premium)
+    if left is not None and len(messages) > left:
+        messages = messages[:left]
+        await message.answer(
+            f"📸 Без Premium сегодня осталось {left} фото — разберу только первые {left}.\n"
+            "💎 С *TasteBalance Premium* — альбомы без ограничений.",
+            parse_mode="Markdown",
+        )
+
+    await message.answer(f"🧠 Анализирую блюда ({len(messages)} фото)…")
+    photos = [pick_photo_size(m.photo, PHOTO_TARGET_PX[premium]) for m in messages]
+    model = "gemini-2.5-flash" if premium else "gemini-2.5-flash-lite"
+
+    # тот же набор фото (пересланный альбом) уже анализировали
+    file_key = f"{cache_scope('album', model)}:album:" + ",".join(p.file_unique_id for p in photos)
+    result = await cache_get(file_key)
+
+    cache_key = None
+    if result is None:
+        try:
+            images = await asyncio.gather(*(_download_photo(p) for p in photos))
+        except Exception as e:
+            logging.error(f"⚠️ Ошибка загрузки альбома: {e}")
+            await message.answer("⚠️ Не удалось загрузить фото. Проверь соединение и попробуй снова.")
+            return
+
+    # альбом — один анализ, но в дневной лимит идёт каждое фото
+    try:
+        await increment_photo(message.from_user.id, len(messages))
+    except Exception:
+        logging.exception("Ошибка increment_photo")
 
+    try:
+        if result is None:
+            cache_key = make_cache_key(cache_scope("album", model), b"".join(hashlib.sha256(i).digest() for i in images))
+            result = await cache_get(cache_key)
+
+        if result is None:
+            uploads = await asyncio.gather(*(
+                prepare_image(i, premium, max(p.width, p.height)) for i, p in zip(images, photos)
+            ))
+            result, answered = await gemini_flight.do(cache_key, lambda: gemini_resilient(
+                model,
+                prompt_contents("album", *({"mime_type": "image/jpeg", "data": u} for u in uploads)),
+                gemini_decoder.meal,
+                premium,
+                queue_notice(message),
+                json_config(MEAL_SCHEMA),
+            ))
+            if answered != model:
+                # ответила подстраховочная модель: её ответ не должен попасть в кэш основной
+                model = answered
+                file_key = f"{cache_scope('album', model)}:album:" + ",".join(p.file_unique_id for p in photos)
+                cache_key = make_cache_key(cache_scope("album", model), b"".join(hashlib.sha256(i).digest() for i in images))
+
+        meal = gemini_decoder.meal(result)
+        if meal is None:
+            await message.answer("⚠️ Не удалось определить ингредиенты. Попробуй другие фото.")
+            return
 
-        await message.answer(text, parse_mode="Markdown", reply_markup=builder.as_markup())
+        result_json = json.dumps(meal.to_dict(), ensure_ascii=False)
+        await cache_set(file_key, result_json)
+        if cache_key:
+            await cache_set(cache_key, result_json)
 
-        dp.workflow_data[str(message.from_user.id)] = {"meal": {"items": items, "total": total}}
+        await message.answer(
+            meal_summary(meal, f"🍽️ *Обнаружено на {len(messages)} фото:*"),
+            parse_mode="Markdown",
+            reply_markup=meal_keyboard(premium),
+        )
+        await workflows.save(message.from_user.id, Workflow(meal=meal))
 
     except Exception as e:
-        logging.error(f"Ошибка анализа Gemini: {e}")
+        logging.error(f"Ошибка анализа альбома: {e}")
         await message.answer("⚠️ Ошибка анализа фото. Попробуй снова.")
 
+
+albums = AlbumCollector(handle_album)
+
 # ======================================
 # 💎 Premium-заглушки и обработка кнопок
 # ======================================
@@ -1142,7 +3583,7 @@ async def handle_meal_actions(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
     # Проверяем Premium
-    if not is_premium_active(user_id):
+    if not await is_premium_active(user_id):
         promo_text = (
             "💎 *Функции редактирования и управления доступны только в TasteBalance Premium!*\n\n"
             "🚀 Что ты получишь:\n"
@@ -1154,8 +3595,7 @@ async def handle_meal_actions(callback: types.CallbackQuery):
         )
 
         builder = InlineKeyboardBuilder()
-        if not is_premium_active(user_id):
-            builder.button(text="💎 Получить Premium", callback_data="buy_premium")
+        builder.button(text="💎 Получить Premium", callback_data="buy_premium")
         builder.adjust(1)
 
         await callback.message.answer(promo_text, parse_mode="Markdown", reply_markup=builder.as_markup())
@@ -1179,21 +3619,20 @@ async def handle_meal_actions(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "edit_meal")
 async def edit_meal(callback: types.CallbackQuery):
     """Показать список ингредиентов для редактирования."""
-    if not is_premium_active(callback.from_user.id):
+    if not await is_premium_active(callback.from_user.id):
         await callback.message.answer("💎 Редактирование доступно только в Premium.")
         await callback.answer()
         return
 
-    wf = dp.workflow_data.get(str(callback.from_user.id))
-    if not wf or "meal" not in wf:
+    wf = await workflows.get(callback.from_user.id)
+    if not wf or wf.meal is None:
         await callback.message.answer("⚠️ Нет данных для редактирования. Сначала проанализируй фото.")
         await callback.answer()
         return
 
-    items = wf["meal"]["items"]
     builder = InlineKeyboardBuilder()
-    for i, item in enumerate(items):
-        builder.button(text=f"{item['name']} ({item['weight_g']} г)", callback_data=f"edit_item:{i}")
+    for i, item in enumerate(wf.meal.items):
+        builder.button(text=f"{item.name} ({item.weight_g} г)", callback_data=f"edit_item:{i}")
     builder.adjust(2)
 
     await callback.message.answer("🔍 Выберите ингредиент для изменения:", reply_markup=builder.as_markup())
@@ -1204,22 +3643,23 @@ async def edit_meal(callback: types.CallbackQuery):
 async def edit_item(callback: types.CallbackQuery):
     """Выбор действия для конкретного ингредиента."""
     idx = int(callback.data.split(":")[1])
-    wf = dp.workflow_data.get(str(callback.from_user.id))
-    if not wf:
+    wf = await workflows.get(callback.from_user.id)
+    if not wf or wf.meal is None or idx >= len(wf.meal.items):
         await callback.message.answer("⚠️ Ошибка редактирования.")
         await callback.answer()
         return
 
-    wf["editing_index"] = idx
+    wf.editing_index = idx
+    await workflows.save(callback.from_user.id, wf)
     builder = InlineKeyboardBuilder()
     builder.button(text="✏️ Изменить название", callback_data="edit_name")
     builder.button(text="📏 Изменить вес", callback_data="edit_weight")
     builder.button(text="🗑 Удалить", callback_data="delete_item")
     builder.adjust(1)
 
-    item = wf["meal"]["items"][idx]
+    item = wf.meal.items[idx]
     await callback.message.answer(
-        f"🔧 *Ингредиент:* {item['name']} ({item['weight_g']} г)\nЧто хотите изменить?",
+        f"🔧 *Ингредиент:* {item.name} ({item.weight_g} г)\nЧто хотите изменить?",
         parse_mode="Markdown",
         reply_markup=builder.as_markup()
     )
@@ -1228,71 +3668,73 @@ async def edit_item(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "edit_name")
 async def edit_name(callback: types.CallbackQuery):
-    wf = dp.workflow_data.get(str(callback.from_user.id))
-    wf["stage"] = "await_name"
+    wf = await workflows.get(callback.from_user.id)
+    if not wf:
+        await callback.message.answer("⚠️ Ошибка редактирования.")
+        await callback.answer()
+        return
+    wf.stage = "await_name"
+    await workflows.save(callback.from_user.id, wf)
     await callback.message.answer("✏️ Введите новое название ингредиента:")
     await callback.answer()
 
 
 @dp.callback_query(F.data == "edit_weight")
 async def edit_weight(callback: types.CallbackQuery):
-    wf = dp.workflow_data.get(str(callback.from_user.id))
-    wf["stage"] = "await_weight"
+    wf = await workflows.get(callback.from_user.id)
+    if not wf:
+        await callback.message.answer("⚠️ Ошибка редактирования.")
+        await callback.answer()
+        return
+    wf.stage = "await_weight"
+    await workflows.save(callback.from_user.id, wf)
     await callback.message.answer("📏 Введите новый вес (в граммах):")
     await callback.answer()
 
 
 @dp.callback_query(F.data == "delete_item")
 async def delete_item(callback: types.CallbackQuery):
-    wf = dp.workflow_data.get(str(callback.from_user.id))
-    idx = wf.get("editing_index")
-    if idx is None:
+    wf = await workflows.get(callback.from_user.id)
+    idx = wf.editing_index if wf else None
+    if idx is None or wf.meal is None or idx >= len(wf.meal.items):
         await callback.message.answer("⚠️ Ошибка: ингредиент не найден.")
         await callback.answer()
         return
 
-    item = wf["meal"]["items"].pop(idx)
-    await callback.message.answer(f"🗑 Удалено: *{item['name']}*", parse_mode="Markdown")
-    await show_updated_meal(callback.from_user.id)
+    item = wf.meal.items.pop(idx)
+    wf.editing_index = None
+    await callback.message.answer(f"🗑 Удалено: *{item.name}*", parse_mode="Markdown")
+    await show_updated_meal(callback.from_user.id, wf)
     await callback.answer()
 
 # ======================================
 # 🧮 Пересчёт и обновление блюда
 # ======================================
 
-async def show_updated_meal(user_id):
+async def show_updated_meal(user_id, wf=None):
     """Показать пересчитанное блюдо после изменений и добавить кнопку для сохранения."""
-    wf = dp.workflow_data.get(str(user_id))
-    if not wf or "meal" not in wf:
+    if wf is None:
+        wf = await workflows.get(user_id)
+    if not wf or wf.meal is None:
         return
 
-    items = wf["meal"]["items"]
-    total = {"cal": 0, "protein": 0, "fat": 0, "carbs": 0}
-
-    for i in items:
-        total["cal"] += i.get("cal", 0)
-        total["protein"] += i.get("protein", 0)
-        total["fat"] += i.get("fat", 0)
-        total["carbs"] += i.get("carbs", 0)
-
-    # 🔢 Округляем значения для стабильного отображения
-    total = {k: round(v, 2) for k, v in total.items()}
-    wf["meal"]["total"] = total
-
+    meal = wf.meal
+    meal.recalc()
+    await workflows.save(user_id, wf)
 
     text = "🍽️ *Обновлённое блюдо:*\n"
-    for i in items:
-        text += f"- {i['name']} ({i['weight_g']} г)\n"
+    for i in meal.items:
+        text += f"- {i.name} ({i.weight_g} г)\n"
     text += (
-        f"\n🔥 *Итого:* {round(total['cal'])} ккал\n"
-        f"Б: {round(total['protein'])} г  "
-        f"Ж: {round(total['fat'])} г  "
-        f"У: {round(total['carbs'])} г"
+        f"\n🔥 *Итого:* {round(meal.cal)} ккал\n"
+        f"Б: {round(meal.protein)} г  "
+        f"Ж: {round(meal.fat)} г  "
+        f"У: {round(meal.carbs)} г"
     )
 
     builder = InlineKeyboardBuilder()
-    for i, item in enumerate(items):
-        builder.button(text=f"{item['name']} ({item['weight_g']} г)", callback_data=f"edit_item:{i}")
+    for i, item in enumerate(meal.items):
+        builder.button(text=f"{item.name} ({item.weight_g} г)", callback_data=f"edit_item:{i}")
     builder.button(text="✅ Добавить в статистику", callback_data="save_meal_to_stats")
     builder.adjust(2)
 
@@ -1305,20 +3747,14 @@ async def show_updated_meal(user_id):
 @dp.callback_query(F.data == "save_meal_to_stats")
 async def save_meal_to_stats(callback: types.CallbackQuery):
     """Добавление обновлённого блюда в статистику."""
-    wf = dp.workflow_data.get(str(callback.from_user.id))
-    if not wf or "meal" not in wf:
+    wf = await workflows.get(callback.from_user.id)
+    if not wf or wf.meal is None:
         await callback.message.answer("⚠️ Нет данных для сохранения. Попробуйте снова.")
         await callback.answer()
         return
 
-    total = wf["meal"]["total"]
-    kcal = total.get("cal", 0)
-    p = total.get("protein", 0)
-    f = total.get("fat", 0)
-    c = total.get("carbs", 0)
-
-    desc = ", ".join([i["name"] for i in wf["meal"]["items"]])
-    save_meal(callback.from_user.id, desc, kcal, p, f, c)
+    meal = wf.meal
+    await save_meal(callback.from_user.id, meal.description(), meal.cal, meal.protein, meal.fat, meal.carbs)
 
     await callback.message.answer("✅ Блюдо успешно добавлено в статистику за сегодня!")
     await callback.answer()
@@ -1327,23 +3763,516 @@ async def save_meal_to_stats(callback: types.CallbackQuery):
 # 🕒 Автоматические отчёты для Premium
 # ======================================
 
+REPORT_TITLES = {"week": "📅 *Отчёт за неделю*", "month": "🗓️ *Отчёт за месяц*"}
+REPORT_PREVIOUS = {"week": "прошлой неделе", "month": "прошлому месяцу"}
+
+
+def format_period_report(kind, day, kcal, p, f, c, days, prev_kcal=None, prev_days=None):
+    """Средние за день, доли БЖУ по калориям и сравнение с прошлым периодом."""
+    start, end = period_bounds(kind, day)
+    avg = kcal / days
+    text = (
+        f"{REPORT_TITLES[kind]} ({start:%d.%m}–{end:%d.%m})\n\n"
+        f"📆 Дней с записями: {days}\n"
+        f"🔥 В среднем: {round(avg)} ккал в день\n"
+        f"Б: {round(p / days)} г  Ж: {round(f / days)} г  У: {round(c / days)} г\n"
+    )
+    macro_kcal = p * 4 + f * 9 + c * 4
+    if macro_kcal > 0:
+        text += (
+            f"🥗 Доли: Б {round(p * 4 * 100 / macro_kcal)}% · "
+            f"Ж {round(f * 9 * 100 / macro_kcal)}% · У {round(c * 4 * 100 / macro_kcal)}%\n"
+        )
+    if prev_kcal and prev_days:
+        prev_avg = prev_kcal / prev_days
+        diff = avg - prev_avg
+        arrow = "📈" if diff > 0 else "📉" if diff < 0 else "➡️"
+        text += f"{arrow} К {REPORT_PREVIOUS[kind]}: {diff:+.0f} ккал в день ({diff * 100 / prev_avg:+.0f}%)"
+    return text
+
+
+async def period_report_rows(kind, day, user_ids):
+    """
+    Одним запросом на пачку пользователей: суммы за период, прошлый период и отметка об отправке.
+    → [(user_id, kcal, p, f, c, days, prev_kcal, prev_days, sent), ...]
+    """
+    period = period_key(kind, day)
+    previous = period_key(kind, period_bounds(kind, day)[0] - timedelta(days=1))
+    marks = ",".join("?" * len(user_ids))
+    return await db.fetchall(
+        f"""
+        SELECT cur.user_id, cur.kcal, cur.p, cur.f, cur.c, cur.days, prev.kcal, prev.days,
+               l.user_id IS NOT NULL
+        FROM period_totals cur
+        LEFT JOIN period_totals prev
+            ON prev.user_id = cur.user_id AND prev.kind = cur.kind AND prev.period = ?
+        LEFT JOIN summary_ledger l
+            ON l.user_id = cur.user_id AND l.kind = cur.kind AND l.period = cur.period
+        WHERE cur.kind = ? AND cur.period = ? AND cur.user_id IN ({marks}) AND cur.days > 0
+        """,
+        (previous, kind, period, *user_ids),
+    )
+
+
+async def period_report(user_id, kind):
+    """Отчёт пользователя за текущую неделю или месяц (по запросу)."""
+    today = date.today()
+    rows = await period_report_rows(kind, today, [user_id])
+    if not rows:
+        return None
+    _, kcal, p, f, c, days, prev_kcal, prev_days, _ = rows[0]
+    return format_period_report(kind, today, kcal, p, f, c, days, prev_kcal, prev_days)
+
+
+@dp.message(Command("week", "month"))
+async def period_report_cmd(message: types.Message):
+    kind = "week" if message.text.lstrip("/").startswith("week") else "month"
+    if not await is_premium_active(message.from_user.id):
+        builder = InlineKeyboardBuilder()
+        builder.button(text="💎 Получить Premium", callback_data="buy_premium")
+        await message.answer("📅 Отчёты за неделю и месяц доступны в *Premium*.",
+                             parse_mode="Markdown", reply_markup=builder.as_markup())
+        return
+    text = await period_report(message.from_user.id, kind)
+    await message.answer(text or "🫙 За этот период ещё ничего не добавлено.", parse_mode="Markdown")
+
+
+# ======================================
+# 📣 Рассылка автоотчётов
+# ======================================
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))     # сообщений в секунду (лимит Telegram ~30)
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))   # одновременных отправок
+BROADCAST_RETRIES = int(os.getenv("BROADCAST_RETRIES", "5"))
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, запас до burst; pause() — после 429 от Telegram."""
+
+    def __init__(self, rate=BROADCAST_RATE, burst=BROADCAST_BURST):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class Broadcaster:
+    """
+    Массовая отправка: ограниченное число параллельных отправителей, общий TokenBucket,
+    RetryAfter ставит на паузу всю рассылку, а не один поток.
+    """
+
+    def __init__(self, bucket=None, workers=BROADCAST_WORKERS, retries=BROADCAST_RETRIES):
+        self.bucket = bucket or TokenBucket()
+        self.workers = workers
+        self.retries = retries
+        self.last = {}
+
+    async def _deliver(self, chat_id, text, counters):
+        for attempt in range(self.retries):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id, text, parse_mode="Markdown")
+                return "sent"
+            except TelegramRetryAfter as e:
+                counters["retry_after"] += 1
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"  # пользователь заблокировал бота
+            except TelegramNetworkError:
+                await asyncio.sleep(backoff_delay(attempt))
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось отправить отчёт {chat_id}: {e}")
+                return "failed"
+        return "failed"
+
+    async def run(self, jobs, on_done=None):
+        """jobs — [(chat_id, text), ...]; on_done(chat_id, status) вызывается после каждой отправки."""
+        pending = deque(jobs)
+        counters = {"sent": 0, "blocked": 0, "failed": 0, "retry_after": 0}
+        latencies = []
+        started = time.monotonic()
+
+        async def worker():
+            while pending:
+                chat_id, text = pending.popleft()
+                sent_at = time.monotonic()
+                status = await self._deliver(chat_id, text, counters)
+                latencies.append(time.monotonic() - sent_at)
+                counters[status] += 1
+                if on_done is not None:
+                    try:
+                        await on_done(chat_id, status)
+                    except Exception:
+                        logging.exception("Ошибка записи в журнал рассылки")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(pending)))))
+
+        elapsed = time.monotonic() - started
+        latencies.sort()
+        self.last = {
+            **counters,
+            "total": len(latencies),
+            "seconds": round(elapsed, 2),
+            "per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "latency_avg_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+            "latency_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else 0.0,
+        }
+        if latencies:
+            logging.info(f"📣 Рассылка: {self.last}")
+        return self.last
+
+
+broadcaster = Broadcaster()
+
+
+async def ledger_claim(kind, period, jobs):
+    """
+    Записать отчёты в журнал до отправки и вернуть только те jobs, которые заняли мы.
+    INSERT OR IGNORE со своей меткой: если отчёт уже занял другой процесс на той же базе
+    (или он уже отправлен), строка не наша и второй копии не будет.
+    Упали между записью и отправкой — отчёт пропадает, но не дублируется.
+    """
+    token = f"sending:{os.urandom(8).hex()}"
+    await db.transaction([
+        ("INSERT OR IGNORE INTO summary_ledger (user_id, kind, period, status, sent_at) VALUES (?, ?, ?, ?, ?)",
+         (user_id, kind, period, token, time.time()))
+        for user_id, _ in jobs
+    ], wait=True)
+    ids = [user_id for user_id, _ in jobs]
+    claimed = set()
+    for i in range(0, len(ids), SUMMARY_QUERY_CHUNK):
+        chunk = ids[i:i + SUMMARY_QUERY_CHUNK]
+        rows = await db.fetchall(
+            f"SELECT user_id FROM summary_ledger WHERE kind=? AND period=? AND status=? "
+            f"AND user_id IN ({','.join('?' * len(chunk))})",
+            (kind, period, token, *chunk),
+        )
+        claimed.update(user_id for user_id, in rows)
+    return [job for job in jobs if job[0] in claimed]
+
+
+def ledger_writer(kind, period, failed=None):
+    """on_done для Broadcaster.run: итог отправки в журнал; неудачные — в множество failed для повтора."""
+    async def mark(user_id, status):
+        if status == "failed":
+            if failed is not None:
+                failed.add(user_id)
+            # снимаем занятую ledger_claim строку — при повторе отчёт можно будет занять снова
+            await db.execute(
+                "DELETE FROM summary_ledger WHERE user_id=? AND kind=? AND period=?", (user_id, kind, period)
+            )
+        else:
+            await db.execute(
+                "UPDATE summary_ledger SET status=?, sent_at=? WHERE user_id=? AND kind=? AND period=?",
+                (status, time.time(), user_id, kind, period),
+            )
+    return mark
+
+
+# ======================================
+# ⏰ Расписание автоотчётов по часовым поясам
+# ======================================
+
+SUMMARY_HOUR = int(os.getenv("SUMMARY_HOUR", "21"))               # местное время пользователя
+SUMMARY_DEFAULT_TZ = os.getenv("SUMMARY_DEFAULT_TZ", "")          # пусто — часовой пояс сервера
+SUMMARY_BATCH_SLACK = float(os.getenv("SUMMARY_BATCH_SLACK", "1"))  # срабатывания ближе секунды — одной пачкой
+SUMMARY_RETRY_DELAY = float(os.getenv("SUMMARY_RETRY_DELAY", "600"))  # повтор неотправленных, пока идёт час отчётов
+SUMMARY_SCHEDULER = os.getenv("SUMMARY_SCHEDULER", "1") == "1"         # 0 — автоотчёты рассылает другой процесс
+SUMMARY_QUERY_CHUNK = 500  # user_id в одном IN (...)
+
+_TZ_OFFSET_RE = re.compile(r"^(?:utc|gmt)?\s*([+-])\s*(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+
+
+def parse_timezone(value):
+    """'Europe/Moscow', '+3', 'UTC+05:30' → (каноническая строка, tzinfo) или None."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    m = _TZ_OFFSET_RE.match(value)
+    if m:
+        sign, hours, minutes = m.group(1), int(m.group(2)), int(m.group(3) or 0)
+        if hours > 14 or minutes >= 60:
+            return None
+        offset = timedelta(hours=hours, minutes=minutes) * (-1 if sign == "-" else 1)
+        name = f"UTC{sign}{hours:02d}:{minutes:02d}"
+        return name, timezone(offset, name)
+    try:
+        return value, ZoneInfo(value)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def user_zone(tz):
+    parsed = parse_timezone(tz) or parse_timezone(SUMMARY_DEFAULT_TZ)
+    return parsed[1] if parsed else None  # None — локальное время сервера
+
+
+def next_summary_at(tz, now=None, catch_up=False):
+    """Ближайшие SUMMARY_HOUR:00 по местному времени (timestamp); catch_up — если час уже идёт, то сейчас."""
+    now = now or time.time()
+    local = datetime.fromtimestamp(now, user_zone(tz) or None)
+    if catch_up and local.hour == SUMMARY_HOUR:
+        return now
+    fire = local.replace(hour=SUMMARY_HOUR, minute=0, second=0, microsecond=0)
+    if fire.timestamp() <= now:
+        fire = (local + timedelta(days=1)).replace(hour=SUMMARY_HOUR, minute=0, second=0, microsecond=0)
+    return fire.timestamp()
+
+
+class SummaryScheduler:
+    """
+    Куча (время срабатывания, user_id) по всем Premium-пользователям.
+    Спим ровно до ближайшего срабатывания, забираем всех, у кого время подошло, — одной пачкой.
+    Изменение пояса или статуса — новая запись в куче, старая отбрасывается при извлечении.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}    # user_id -> (время срабатывания, tz) — актуальная запись
+        self._wake = asyncio.Event()
+        self._tasks = set()
+        self.fired = 0
+
+    def schedule(self, user_id, tz, catch_up=False, after=None):
+        self._push(user_id, tz, next_summary_at(tz, after, catch_up))
+
+    def retry(self, user_id, tz, now=None):
+        """Повторить отчёт через SUMMARY_RETRY_DELAY, если у пользователя ещё идёт час отчётов, иначе — завтра."""
+        fire_at = (now or time.time()) + SUMMARY_RETRY_DELAY
+        if datetime.fromtimestamp(fire_at, user_zone(tz) or None).hour == SUMMARY_HOUR:
+            self._push(user_id, tz, fire_at)
+        else:
+            self.schedule(user_id, tz, after=fire_at)
+
+    def _push(self, user_id, tz, fire_at):
+        self._due[user_id] = (fire_at, tz)
+        heapq.heappush(self._heap, (fire_at, user_id))
+        if self._heap[0][1] == user_id:
+            self._wake.set()  # появилось более раннее срабатывание
+
+    def unschedule(self, user_id):
+        self._due.pop(user_id, None)
+
+    async def load(self):
+        """Один проход по Premium-пользователям при старте."""
+        rows = await db.fetchall("SELECT user_id, tz FROM users WHERE is_premium=1")
+        for user_id, tz in rows:
+            self.schedule(user_id, tz, catch_up=True)
+        logging.info(f"⏰ Автоотчёты запланированы: {len(rows)} пользователей")
+
+    async def refresh(self, user_id):
+        """Пояс или статус пользователя изменились — пересчитать его срабатывание."""
+        row = await db.fetchone("SELECT is_premium, tz FROM users WHERE user_id=?", (user_id,))
+        if row and row[0]:
+            self.schedule(user_id, row[1])
+        else:
+            self.unschedule(user_id)
+
+    def _pop_due(self, now):
+        batch = []
+        while self._heap and self._heap[0][0] <= now + SUMMARY_BATCH_SLACK:
+            fire_at, user_id = heapq.heappop(self._heap)
+            current = self._due.get(user_id)
+            if current is not None and current[0] == fire_at:
+                batch.append((user_id, current[1]))
+        return batch
+
+    async def run(self):
+        while True:
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = self._pop_due(time.time())
+            if batch:
+                self.fired += len(batch)
+                task = asyncio.create_task(self._fire(batch))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _fire(self, batch):
+        """Пачка пользователей, у которых наступил вечер: отчёты за их местную дату."""
+        by_day = {}
+        for user_id, tz in batch:
+            day = datetime.now(user_zone(tz)).date().isoformat()
+            by_day.setdefault(day, []).append((user_id, tz))
+
+        for day, users in by_day.items():
+            premium_ids = []
+            failed = set()  # не доставлено — повторим, пока у пользователя идёт час отчётов
+            checked = False
+            jobs = []
+            try:
+                for i in range(0, len(users), SUMMARY_QUERY_CHUNK):
+                    chunk = [u for u, _ in users[i:i + SUMMARY_QUERY_CHUNK]]
+                    for user_id, kcal, p, f, c, sent in await daily_summary_rows(day, chunk):
+                        premium_ids.append(user_id)
+                        if kcal and not sent:
+                            jobs.append((user_id, f"📊 *Отчёт за сегодня:*\n"
+                                                  f"Ккал: {round(kcal)}\n"
+                                                  f"Б: {round(p)} г  Ж: {round(f)} г  У: {round(c)} г"))
+                checked = True
+                jobs = await ledger_claim("daily", day, jobs) if jobs else jobs
+                if jobs:
+                    await broadcaster.run(jobs, ledger_writer("daily", day, failed))
+
+                # воскресенье — ещё и итоги недели, последний день месяца — итоги месяца
+                local_day = date.fromisoformat(day)
+                for kind in ("week", "month"):
+                    if period_bounds(kind, local_day)[1] == local_day and premium_ids:
+                        await self._fire_period(kind, local_day, premium_ids, failed)
+            except Exception:
+                logging.exception("Ошибка рассылки отчётов")
+                if not checked:
+                    failed.update(u for u, _ in users)  # статус не проверили — попробуем ещё раз
+            finally:
+                # пачка уже вынута из кучи: каждого нужно вернуть туда или снять, даже после ошибки
+                premium, now = set(premium_ids), time.time()
+                for user_id, tz in users:
+                    if user_id in failed:
+                        self.retry(user_id, tz, now)
+                    elif user_id in premium or not checked:
+                        # следующий отчёт завтра (минута запаса от раннего срабатывания)
+                        self.schedule(user_id, tz, after=now + 60)
+                    else:
+                        self.unschedule(user_id)  # Premium закончился
+
+    async def _fire_period(self, kind, day, user_ids, failed=None):
+        jobs = []
+        for i in range(0, len(user_ids), SUMMARY_QUERY_CHUNK):
+            rows = await period_report_rows(kind, day, user_ids[i:i + SUMMARY_QUERY_CHUNK])
+            for user_id, kcal, p, f, c, days, prev_kcal, prev_days, sent in rows:
+                if not sent:
+                    jobs.append((user_id, format_period_report(kind, day, kcal, p, f, c, days, prev_kcal, prev_days)))
+        jobs = await ledger_claim(kind, period_key(kind, day), jobs) if jobs else jobs
+        if jobs:
+            await broadcaster.run(jobs, ledger_writer(kind, period_key(kind, day), failed))
+
+    def stats(self):
+        return {"scheduled": len(self._due), "heap": len(self._heap), "fired": self.fired,
+                "next_in_s": round(self._heap[0][0] - time.time(), 1) if self._heap else None}
+
+
+async def daily_summary_rows(day, user_ids):
+    """Одним запросом: кто из user_ids ещё Premium, их КБЖУ за день и был ли уже отправлен отчёт."""
+    marks = ",".join("?" * len(user_ids))
+    return await db.fetchall(
+        f"""
+        SELECT u.user_id, d.kcal, d.p, d.f, d.c, l.user_id IS NOT NULL
+        FROM users u
+        LEFT JOIN daily_totals d ON d.user_id = u.user_id AND d.date = ?
+        LEFT JOIN summary_ledger l ON l.user_id = u.user_id AND l.kind = 'daily' AND l.period = ?
+        WHERE u.user_id IN ({marks})
+          AND u.is_premium = 1
+          AND (u.premium_until IS NULL OR u.premium_until = '' OR u.premium_until >= ?)
+        """,
+        (day, day, *user_ids, datetime.now().isoformat()),
+    )
+
+
+summary_scheduler = SummaryScheduler()
+
+
 async def send_summaries():
-    """Автоотчёты для Premium-пользователей в 21:00."""
+    """Автоотчёты для Premium-пользователей в SUMMARY_HOUR:00 по их местному времени."""
+    await summary_scheduler.load()
+    await summary_scheduler.run()
+
+
+# ======================================
+# 🌍 Часовой пояс
+# ======================================
+
+@dp.message(Command("timezone"))
+async def timezone_cmd(message: types.Message):
+    """/timezone Europe/Moscow или /timezone +3 — когда присылать вечерний отчёт."""
+    arg = (message.text or "").partition(" ")[2]
+    user_id = message.from_user.id
+    if not arg.strip():
+        row = await db.fetchone("SELECT tz FROM users WHERE user_id=?", (user_id,))
+        current = (row and row[0]) or SUMMARY_DEFAULT_TZ or "время сервера"
+        await message.answer(
+            f"🌍 Твой часовой пояс: *{current}*\n\n"
+            f"Отчёт приходит в {SUMMARY_HOUR}:00 по местному времени.\n"
+            "Изменить: `/timezone Europe/Moscow` или `/timezone +3`",
+            parse_mode="Markdown",
+        )
+        return
+
+    parsed = parse_timezone(arg)
+    if parsed is None:
+        await message.answer("⚠️ Не знаю такой пояс. Пример: `/timezone Asia/Almaty` или `/timezone +5`", parse_mode="Markdown")
+        return
+
+    await get_user(user_id)  # создаём запись, если её ещё нет
+    await db.execute("UPDATE users SET tz=? WHERE user_id=?", (parsed[0], user_id), wait=True)
+    await summary_scheduler.refresh(user_id)
+    local = datetime.now(parsed[1]).strftime("%H:%M")
+    await message.answer(f"✅ Часовой пояс: *{parsed[0]}* (сейчас там {local})", parse_mode="Markdown")
+
+# ======================================
+# 📈 Метрики
+# ======================================
+
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "600"))  # секунды; 0 — не писать в лог
+
+# раздел сводки -> функция, возвращающая счётчики
+METRICS = {
+    "inference": inference.stats,
+    "tokens": token_meter.stats,
+    "decoder": gemini_decoder.stats,
+    "single_flight": gemini_flight.stats,
+    "result_cache": result_cache.stats,
+    "db": db.stats,
+    "photo_index": photo_index.stats,
+    "nutrition": nutrition_index.stats,
+    "manual_parse": lambda: dict(manual_parse_stats),
+}
+
+
+def metrics_snapshot():
+    snapshot = {}
+    for name, stats in METRICS.items():
+        try:
+            snapshot[name] = stats()
+        except Exception as e:
+            snapshot[name] = f"ошибка: {e}"
+    return snapshot
+
+
+async def metrics_reporter(interval=METRICS_LOG_INTERVAL):
+    """Периодически писать в лог все счётчики (очередь Gemini, кэши, разбор ответов…)."""
     while True:
-        now = datetime.now()
-        if now.hour == 21 and now.minute < 10:
-            cursor.execute("SELECT user_id FROM users WHERE is_premium=1")
-            for (uid,) in cursor.fetchall():
-                kcal, p, f, c = get_stats(uid)
-                if kcal > 0:
-                    await bot.send_message(
-                        uid,
-                        f"📊 *Отчёт за сегодня:*\n"
-                        f"Ккал: {round(kcal)}\n"
-                        f"Б: {round(p)} г  Ж: {round(f)} г  У: {round(c)} г",
-                        parse_mode="Markdown"
-                    )
-        await asyncio.sleep(600)
+        await asyncio.sleep(interval)
+        logging.info(f"📈 Метрики: {json.dumps(metrics_snapshot(), ensure_ascii=False)}")
+
 
 # ======================================
 # ▶️ Запуск TasteBalance
@@ -1352,15 +4281,47 @@ async def send_summaries():
 async def main():
     await set_commands(bot)
 
-    # Запускаем Stripe webhook server, если настроен или для теста
+    # Stripe, страницы оплаты и (если задан WEBHOOK_URL) Telegram webhook — один веб-сервер
+    webhook = WebhookWorkers() if WEBHOOK_URL else None
+    runner = None
     try:
-        asyncio.create_task(start_stripe_webserver(host="0.0.0.0", port=8080))
+        runner = await start_webserver(build_web_app(webhook))
     except Exception as e:
-        logging.exception("Failed to start stripe webserver: %s", e)
+        logging.exception("Failed to start webserver: %s", e)
+        webhook = None  # без веб-сервера webhook не примет апдейты
+
+    if photo_index.enabled:
+        await photo_index.load()
 
-    asyncio.create_task(send_summaries())
+    if SUMMARY_SCHEDULER:
+        asyncio.create_task(send_summaries())
+    else:
+        logging.info("⏰ Автоотчёты в этом процессе отключены (SUMMARY_SCHEDULER=0)")
+    asyncio.create_task(workflow_janitor())
+    if METRICS_LOG_INTERVAL > 0:
+        asyncio.create_task(metrics_reporter())
     logging.info("🚀 TasteBalance запущен и готов к приёму сообщений.")
-    await dp.start_polling(bot)
+    try:
+        if webhook is None or not await run_webhook(webhook):
+            # long polling: без WEBHOOK_URL или если webhook не удалось зарегистрировать
+            try:
+                await bot.delete_webhook()  # иначе getUpdates вернёт конфликт с ранее установленным webhook
+            except Exception:
+                logging.exception("Не удалось снять webhook")
+            await dp.start_polling(bot)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await close_http_session()
 
 if __name__ == "__main__":
+    if "--explain" in sys.argv:
+        # python taste.py --explain — планы и время горячих запросов на текущей базе
+        explain_hot_queries()
+        sys.exit(0)
+    if "--rebuild-daily-totals" in sys.argv:
+        # python taste.py --rebuild-daily-totals — пересчитать дневные суммы и выйти
+        logging.info(f"📊 daily_totals пересобрана: {rebuild_daily_totals()} дней")
+        sys.exit(0)
+    start_resize_pool()
     asyncio.run(main())
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# taste.py при импорте создаёт Bot и открывает базу — подставляем токен нужного формата и временный файл
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="tastebalance-"), "test.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
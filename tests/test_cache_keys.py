@@ -0,0 +1,21 @@
+import taste
+
+
+def test_prompt_variants_do_not_share_cache(monkeypatch):
+    model = "gemini-2.5-flash"
+    monkeypatch.setattr(taste, "PROMPT_VARIANT", "full")
+    full = taste.make_cache_key(taste.cache_scope("manual", model), "manual:борщ")
+    monkeypatch.setattr(taste, "PROMPT_VARIANT", "compact")
+    compact = taste.make_cache_key(taste.cache_scope("manual", model), "manual:борщ")
+    assert full != compact
+    assert compact.startswith(f"{model}|manual/compact-1:")
+
+
+def test_cache_hits_are_metered_per_prompt_version():
+    meter = taste.TokenMeter()
+    meter.record("gemini-2.5-flash", "photo/full-1", 100, 50, 1.0)
+    meter.cache_hit("gemini-2.5-flash", "photo/full-1")
+    meter.cache_hit("gemini-2.5-flash-lite", "photo/compact-1")
+    stats = meter.stats()
+    assert stats["gemini-2.5-flash|photo/full-1"]["cache_hits"] == 1
+    assert stats["gemini-2.5-flash-lite|photo/compact-1"] == {"calls": 0, "cache_hits": 1}
@@ -0,0 +1,50 @@
+import asyncio
+
+import taste
+
+
+def test_probe_cancelled_while_queued_releases_breaker(monkeypatch):
+    model = "gemini-test"
+    breaker = taste.CircuitBreaker(failures=1, cooldown=0.05)
+    scheduler = taste.InferenceScheduler(limits={model: 1})
+    monkeypatch.setattr(taste, "breaker", breaker)
+    monkeypatch.setattr(taste, "inference", scheduler)
+
+    async def scenario():
+        breaker.failure(model)
+        assert not breaker.allow(model)
+        await asyncio.sleep(0.06)
+        assert breaker.allow(model)  # пробный запрос после cooldown
+
+        await scheduler.acquire(model)  # слот занят — проба встанет в очередь
+        probe = asyncio.create_task(taste.gemini_generate(model, ["ping"]))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        scheduler.release(model)
+
+        assert breaker.allow(model)  # следующий запрос снова может пробовать
+
+    asyncio.run(scenario())
+
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    scheduler = taste.InferenceScheduler(limits={"m": 1})
+
+    async def scenario():
+        await scheduler.acquire("m")
+        gate = asyncio.Event()
+
+        async def notice(position):
+            await gate.wait()
+
+        waiter = asyncio.create_task(scheduler.acquire("m", on_queued=notice))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release("m")
+        await asyncio.wait_for(scheduler.acquire("m"), 1)
+        assert scheduler.stats()["depth"] == {"m": 0}
+
+    asyncio.run(scenario())
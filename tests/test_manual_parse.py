@@ -0,0 +1,32 @@
+import pytest
+
+from taste import NutritionIndex, parse_manual_meal
+
+
+@pytest.mark.parametrize("text, kcal", [
+    ("овсянка 100г банан 50г", 132.5),
+    ("куриная грудка 150г и рис 200г", 507.5),
+    ("картошка 300г", 261),
+])
+def test_structured_input_is_resolved_locally(text, kcal):
+    meal = parse_manual_meal(text)
+    assert meal is not None
+    assert meal.cal == kcal
+
+
+@pytest.mark.parametrize("text", [
+    "пиво 500мл",              # не «киви»
+    "зефир 50г",               # не «кефир»
+    "печень 200г",             # не «печенье»
+    "картофель с мясом 300г",  # не просто «картофель»
+    "съел тарелку супа",
+])
+def test_ambiguous_input_goes_to_gemini(text):
+    assert parse_manual_meal(text) is None
+
+
+def test_rename_lookup_is_exact_only():
+    index = NutritionIndex()
+    assert index.search("печень", fuzzy=False) is None
+    assert index.search("картошка", fuzzy=False) == "картофель"
+    assert index.search("куриные грудки", fuzzy=False) == "куриная грудка"
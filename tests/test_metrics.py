@@ -0,0 +1,9 @@
+import json
+
+import taste
+
+
+def test_metrics_snapshot_is_json_serializable():
+    snapshot = taste.metrics_snapshot()
+    assert set(snapshot) == set(taste.METRICS)
+    json.dumps(snapshot, ensure_ascii=False)
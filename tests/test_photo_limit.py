@@ -0,0 +1,21 @@
+from datetime import date
+
+from taste import FREE_PHOTOS_PER_DAY, photos_left
+
+
+def user_row(last_date, photos_today):
+    return (1, 0, last_date, photos_today, None)
+
+
+def test_premium_is_unlimited():
+    assert photos_left(user_row(date.today().isoformat(), 50), premium=True) is None
+
+
+def test_new_day_restores_free_limit():
+    assert photos_left(user_row("2000-01-01", 2), premium=False) == FREE_PHOTOS_PER_DAY
+
+
+def test_each_photo_counts_against_the_limit():
+    today = date.today().isoformat()
+    assert photos_left(user_row(today, 1), premium=False) == FREE_PHOTOS_PER_DAY - 1
+    assert photos_left(user_row(today, 10), premium=False) == 0
@@ -0,0 +1,35 @@
+import asyncio
+import io
+import subprocess
+import sys
+
+import pytest
+
+PIL = pytest.importorskip("PIL.Image")
+
+import taste
+
+
+def _jpeg(size):
+    buf = io.BytesIO()
+    PIL.new("RGB", size, (200, 10, 10)).save(buf, "JPEG", quality=95)
+    return buf.getvalue()
+
+
+def test_size_within_limit_is_not_reencoded():
+    image = _jpeg((800, 600))
+    # бесплатный лимит 768 px, Telegram отдаёт 800 px — пережимать незачем
+    assert asyncio.run(taste.prepare_image(image, False, 800)) is image
+
+
+def test_larger_size_is_downscaled():
+    image = _jpeg((1280, 960))
+    data = asyncio.run(taste.prepare_image(image, False, 1280))
+    with PIL.open(io.BytesIO(data)) as img:
+        assert max(img.size) == taste.PHOTO_TARGET_PX[False]
+
+
+def test_imaging_does_not_import_bot():
+    # модуль выполняется в процессах пула — он не должен тянуть за собой taste.py
+    code = "import sys, imaging; sys.exit('taste' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code], cwd=taste.os.path.dirname(taste.__file__)).returncode == 0